@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 import os
 import requests
 import jwt
@@ -34,6 +34,8 @@ limiter = Limiter(
 
 
 RECOMMENDATION_AGENT_URL = os.environ.get("RECOMMENDATION_AGENT_URL", "http://localhost:8081")
+# For a stream the read timeout is the longest gap allowed between two chunks
+RECOMMENDATION_AGENT_TIMEOUT_SECONDS = float(os.environ.get("RECOMMENDATION_AGENT_TIMEOUT_SECONDS", "30"))
 
 # --- JWT Authentication Decorator ---
 def token_required(f):
@@ -88,11 +90,37 @@ def chat():
     if variant:
         payload['variant'] = variant
 
+    # Streaming mode (e.g., /v1/chat?stream=1) relays the agent's NDJSON events as they arrive
+    if request.args.get('stream') in ('1', 'true'):
+        try:
+            response = requests.post(
+                f"{RECOMMENDATION_AGENT_URL}/recommend",
+                params={"stream": "1"},
+                json=payload,
+                stream=True,
+                timeout=RECOMMENDATION_AGENT_TIMEOUT_SECONDS
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if e.response is not None:
+                e.response.close()
+            return jsonify({"error": f"Failed to connect to recommendation agent: {e}"}), 503
+
+        def relay():
+            # Runs until the stream ends, fails or the client goes away (GeneratorExit)
+            try:
+                yield from response.iter_content(chunk_size=None)
+            finally:
+                response.close()
+
+        return Response(stream_with_context(relay()), mimetype='application/x-ndjson')
+
     try:
         # Forward the request to the recommendation-agent
         response = requests.post(
             f"{RECOMMENDATION_AGENT_URL}/recommend",
-            json=payload
+            json=payload,
+            timeout=RECOMMENDATION_AGENT_TIMEOUT_SECONDS
         )
         response.raise_for_status()  # Raise an exception for bad status codes
         return jsonify(response.json()), response.status_code
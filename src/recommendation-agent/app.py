@@ -2,8 +2,18 @@ import os
 import requests
 import json
 import time
-from flask import Flask, request, jsonify
+import atexit
+import contextvars
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, has_request_context, request, jsonify, stream_with_context
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted
 import grpc
 
 # --- gRPC Imports ---
@@ -12,31 +22,47 @@ from genproto import demo_pb2
 from genproto import demo_pb2_grpc
 
 # --- Caching ---
-from cachetools import LRUCache, cached
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+
+from model_json import ModelResponseError, SuggestionStreamParser, parse_model_response, serialize_response
+from tool_output import compact_json, estimate_tokens, project_product, project_products
+import warmup
+from queries import is_action_intent, load_query_log
+from session_store import ChatSessionStore, is_follow_up
+from stale_cache import StaleCache
+from model_router import ModelRouter
+from token_usage import KINDS as TOKEN_KINDS, TokenUsage, parse_prices
+from experiments import ExperimentStats, serialize_sketches, summarize
+from query_normalizer import DEFAULT_STOP_PHRASES, QueryNormalizer, parse_steps
+from dispatch import DispatchTimeout, FairDispatcher, parse_assignments
 
 # --- Observability ---
-from opentelemetry import metrics
-from opentelemetry.sdk.metrics import MeterProvider
-from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader, ConsoleMetricExporter
-from opentelemetry.sdk.resources import Resource
-
-# For a real-world application, you would export to a system like Prometheus or Cloud Monitoring
-# For this demo, we're exporting to the console.
-resource = Resource(attributes={"service.name": "recommendation-agent"})
-reader = PeriodicExportingMetricReader(ConsoleMetricExporter())
-provider = MeterProvider(resource=resource, metric_readers=[reader])
-metrics.set_meter_provider(provider)
-
-meter = metrics.get_meter("recommendation.agent")
-llm_latency_metric = meter.create_histogram(
-    "llm.latency",
-    unit="ms",
-    description="The latency of the call to the generative AI model"
-)
+# Prometheus metrics, served from /metrics (see telemetry.py)
+import telemetry
 
 # --- Cache Initialization ---
-# Create an LRU cache with a maximum size of 100 entries
-reco_cache = LRUCache(maxsize=100)
+# An LRU cache of recommendations with a soft and a hard TTL (see stale_cache.py).
+# Past the soft TTL an entry is still served while it is refreshed in the background,
+# and if the refresh fails it keeps being served, flagged as stale, until the hard TTL.
+RECO_CACHE_SIZE = int(os.environ.get("RECO_CACHE_SIZE", "100"))
+RECO_CACHE_SOFT_TTL_SECONDS = float(os.environ.get("RECO_CACHE_SOFT_TTL_SECONDS", "600"))
+RECO_CACHE_HARD_TTL_SECONDS = float(os.environ.get("RECO_CACHE_HARD_TTL_SECONDS", "21600"))
+reco_cache = StaleCache(RECO_CACHE_SIZE, RECO_CACHE_SOFT_TTL_SECONDS, RECO_CACHE_HARD_TTL_SECONDS)
+
+# Cache keys use a canonical form of the query (see query_normalizer.py).
+# QUERY_NORMALIZATION is "all", "none" or a list of steps; QUERY_STOP_PHRASES
+# replaces the built-in filler phrases with a comma-separated list.
+QUERY_NORMALIZATION = os.environ.get("QUERY_NORMALIZATION", "all")
+QUERY_STOP_PHRASES = os.environ.get("QUERY_STOP_PHRASES")
+query_normalizer = QueryNormalizer(
+    parse_steps(QUERY_NORMALIZATION),
+    QUERY_STOP_PHRASES.split(",") if QUERY_STOP_PHRASES else DEFAULT_STOP_PHRASES
+)
+
+
+def reco_cache_key(user_query: str, variant: str):
+    return hashkey(query_normalizer.normalize(user_query), variant)
 
 
 app = Flask(__name__)
@@ -48,6 +74,65 @@ if not CATALOG_READER_URL:
 
 PROMO_AGENT_URL = os.environ.get("PROMO_AGENT_URL") # e.g. "http://promo-agent:8080"
 CART_SERVICE_ADDR = os.environ.get('CART_SERVICE_ADDR', 'cartservice:7070')
+CART_RPC_TIMEOUT_SECONDS = float(os.environ.get('CART_RPC_TIMEOUT_SECONDS', '3'))
+
+# End-to-end latency budget for /recommend. A caller can ask for less by sending
+# its remaining deadline in the X-Deadline-Ms header.
+RECOMMEND_LATENCY_BUDGET_SECONDS = float(os.environ.get("RECOMMEND_LATENCY_BUDGET_SECONDS", "10"))
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Part of the budget kept for the keyword fallback's catalog searches (at most half of it)
+FALLBACK_RESERVE_SECONDS = float(os.environ.get("FALLBACK_RESERVE_SECONDS", "1"))
+# No single model call may take longer than this, so a hung call can't hold a thread forever
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", "30"))
+# Threads that run model conversations; how many model calls actually run at once
+# is decided by the dispatch queue below, so this only needs to cover the waiters.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "64"))
+
+# Fair-share dispatch of model calls (see dispatch.py). Caps are per worker process,
+# so a pod allows them times its gunicorn workers and the fleet times the replicas too.
+# LLM_VARIANT_CAPS is e.g. "A=6,B=2"; LLM_USER_WEIGHTS is e.g. "warmup=0.25".
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", "8"))
+LLM_VARIANT_CAPS = {
+    variant.upper(): cap for variant, cap in parse_assignments(os.environ.get("LLM_VARIANT_CAPS", "")).items()
+}
+LLM_USER_WEIGHTS = parse_assignments(os.environ.get("LLM_USER_WEIGHTS", ""), float)
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("LLM_QUEUE_TIMEOUT_SECONDS", "30"))
+LLM_QUOTA_RETRIES = int(os.environ.get("LLM_QUOTA_RETRIES", "3"))
+LLM_QUOTA_BACKOFF_SECONDS = float(os.environ.get("LLM_QUOTA_BACKOFF_SECONDS", "0.5"))
+
+# Routing between a fast and a large model by query complexity (see model_router.py).
+# MODEL_ROUTING_OVERRIDES pins variants to a tier, e.g. "B=large" or "A=auto,B=fast".
+FAST_MODEL_NAME = os.environ.get("FAST_MODEL_NAME", "gemini-1.5-flash-latest")
+LARGE_MODEL_NAME = os.environ.get("LARGE_MODEL_NAME", "gemini-1.5-pro-latest")
+MODEL_COMPLEXITY_THRESHOLD = int(os.environ.get("MODEL_COMPLEXITY_THRESHOLD", "3"))
+MODEL_ROUTING_OVERRIDES = parse_assignments(os.environ.get("MODEL_ROUTING_OVERRIDES", ""), str)
+
+# Token accounting (see token_usage.py). 0 means unlimited; MODEL_PRICES overrides
+# the USD per million input:output tokens, e.g. "gemini-1.5-pro-latest=1.25:5.00".
+# The daily budget is shared by the processes using LLM_TOKEN_BUDGET_DIR, by default
+# the gunicorn workers of the pod. Replicas only share it, and it only survives a pod
+# restart, if that directory is on a volume; otherwise each replica gets the whole budget.
+LLM_DAILY_TOKEN_BUDGET = int(os.environ.get("LLM_DAILY_TOKEN_BUDGET", "0"))
+LLM_TOKEN_BUDGET_DIR = os.environ.get("LLM_TOKEN_BUDGET_DIR") or (
+    os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "token-budget")
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR") else None
+)
+MODEL_PRICES = parse_prices(os.environ.get("MODEL_PRICES", ""))
+TOKEN_WINDOW_REFRESH_SECONDS = float(os.environ.get("TOKEN_WINDOW_REFRESH_SECONDS", "15"))
+
+# Cache warm-up from a query log before reporting ready (see warmup.py)
+WARMUP_QUERY_LOG = os.environ.get("WARMUP_QUERY_LOG")
+WARMUP_TOP_N = int(os.environ.get("WARMUP_TOP_N", "50"))
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", "4"))
+WARMUP_MAX_RPS = float(os.environ.get("WARMUP_MAX_RPS", "2"))
+WARMUP_TIMEOUT_SECONDS = float(os.environ.get("WARMUP_TIMEOUT_SECONDS", "120"))
+
+# Per-user chat history for follow-up questions (see session_store.py)
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", "10000"))
+SESSION_IDLE_TIMEOUT_SECONDS = float(os.environ.get("SESSION_IDLE_TIMEOUT_SECONDS", "1800"))
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", "1500"))
+SESSION_MEMORY_CAP_BYTES = int(os.environ.get("SESSION_MEMORY_CAP_BYTES", str(32 * 1024 * 1024)))
+SESSION_GAUGE_REFRESH_SECONDS = float(os.environ.get("SESSION_GAUGE_REFRESH_SECONDS", "15"))
 
 try:
     GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
@@ -55,6 +140,208 @@ try:
 except KeyError:
     raise RuntimeError("GOOGLE_API_KEY environment variable not set.")
 
+TOOL_HTTP_TIMEOUT_SECONDS = float(os.environ.get("TOOL_HTTP_TIMEOUT_SECONDS", "5"))
+TOOL_HTTP_POOL_SIZE = int(os.environ.get("TOOL_HTTP_POOL_SIZE", "20"))
+TOOL_CACHE_TTL_SECONDS = int(os.environ.get("TOOL_CACHE_TTL_SECONDS", "300"))
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", "1024"))
+
+# Projection of catalog results handed back to the model (see tool_output.py)
+TOOL_OUTPUT_FIELDS = tuple(
+    f.strip() for f in os.environ.get("TOOL_OUTPUT_FIELDS", "id,name,priceUsd,categories,description").split(",") if f.strip()
+)
+TOOL_OUTPUT_TOP_K = int(os.environ.get("TOOL_OUTPUT_TOP_K", "5"))
+TOOL_OUTPUT_DESCRIPTION_CHARS = int(os.environ.get("TOOL_OUTPUT_DESCRIPTION_CHARS", "120"))
+
+# Product details prefetched after each search (0 disables the prefetch)
+PREFETCH_TOP_K = int(os.environ.get("PREFETCH_TOP_K", "3"))
+PREFETCH_MAX_PARALLELISM = int(os.environ.get("PREFETCH_MAX_PARALLELISM", "4"))
+
+
+# --- Shared HTTP Session ---
+# A single pooled session keeps connections to catalog-reader and promo-agent
+# alive across tool calls instead of opening a new connection every time.
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TOOL_HTTP_POOL_SIZE)
+http_session.mount("http://", http_adapter)
+http_session.mount("https://", http_adapter)
+
+
+# --- Tool-Result Cache ---
+# The model often repeats the same search within a conversation and across users,
+# so catalog lookups are cached for a short TTL, keyed by their normalized arguments.
+tool_cache = TTLCache(maxsize=TOOL_CACHE_SIZE, ttl=TOOL_CACHE_TTL_SECONDS)
+tool_cache_lock = threading.Lock()
+
+
+def cached_tool_call(tool_name: str, key_func):
+    """
+    Decorator for the backend lookups behind the tools.
+    Results are cached by (tool_name, key_func(*args)); exceptions are not cached.
+    Cache hits and misses are counted per tool.
+    """
+    def decorator(fetch):
+        @functools.wraps(fetch)
+        def wrapper(*args):
+            key = (tool_name, key_func(*args))
+            with tool_cache_lock:
+                result = tool_cache.get(key)
+            if result is not None:
+                telemetry.tool_cache_hits.labels(tool_name).inc()
+                return result
+
+            telemetry.tool_cache_misses.labels(tool_name).inc()
+            result = fetch(*args)
+            with tool_cache_lock:
+                tool_cache[key] = result
+            return result
+        return wrapper
+    return decorator
+
+
+def compact_tool_output(tool_name: str, raw_payload, projected_payload) -> str:
+    """Serializes a projected tool result and records the token estimates before and after."""
+    raw_tokens = estimate_tokens(json.dumps(raw_payload))
+    output = compact_json(projected_payload)
+    projected_tokens = estimate_tokens(output)
+    telemetry.tool_output_tokens.labels(tool_name, "raw").observe(raw_tokens)
+    telemetry.tool_output_tokens.labels(tool_name, "projected").observe(projected_tokens)
+    print(f"METRIC: {tool_name} output tokens: {raw_tokens} raw -> {projected_tokens} projected")
+    return output
+
+
+@cached_tool_call("search_products", lambda query: " ".join(query.lower().split()))
+def fetch_search_results(query: str) -> str:
+    response = http_session.post(
+        f"{CATALOG_READER_URL}/products:search",
+        json={"query": query},
+        timeout=TOOL_HTTP_TIMEOUT_SECONDS
+    )
+    response.raise_for_status()
+    products = response.json()
+    return compact_tool_output("search_products", products, project_products(
+        products, TOOL_OUTPUT_FIELDS, TOOL_OUTPUT_TOP_K, TOOL_OUTPUT_DESCRIPTION_CHARS
+    ))
+
+
+@cached_tool_call("get_product_details", lambda product_id: product_id.strip())
+def fetch_product_details(product_id: str) -> str:
+    response = http_session.get(
+        f"{CATALOG_READER_URL}/products/{product_id.strip()}",
+        timeout=TOOL_HTTP_TIMEOUT_SECONDS
+    )
+    response.raise_for_status()
+    product = response.json()
+    # The details tool is asked for one product, so its description is not clipped
+    return compact_tool_output("get_product_details", product, project_product(product, TOOL_OUTPUT_FIELDS))
+
+
+# --- Speculative Prefetch ---
+# After a search the model usually asks for the details of the top hits next. While
+# it is still thinking, those details are fetched in the background into the
+# tool-result cache, so the follow-up get_product_details calls don't wait on
+# catalog-reader. A prefetch nobody asks for within the tool cache TTL counts as
+# unused, and one that is asked for only counts as used if its fetch succeeded;
+# the used/started ratio is what PREFETCH_TOP_K should be tuned by.
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_PARALLELISM, thread_name_prefix="prefetch")
+pending_prefetches = OrderedDict()  # product id -> (future, start time)
+prefetch_lock = threading.Lock()
+
+
+def prefetch_failed(future) -> bool:
+    return future.done() and future.exception() is not None
+
+
+def expire_prefetches():
+    """Drops prefetches older than the tool cache TTL. Must be called with prefetch_lock held."""
+    cutoff = time.monotonic() - TOOL_CACHE_TTL_SECONDS
+    while pending_prefetches and next(iter(pending_prefetches.values()))[1] < cutoff:
+        _, (future, _) = pending_prefetches.popitem(last=False)
+        telemetry.tool_prefetches.labels("failed" if prefetch_failed(future) else "unused").inc()
+
+
+def expire_prefetches_forever():
+    # Without this, unused prefetches would only be counted when the next search starts
+    while True:
+        time.sleep(TOOL_CACHE_TTL_SECONDS)
+        with prefetch_lock:
+            expire_prefetches()
+
+
+def prefetch_product_details(search_output: str):
+    """Starts background detail lookups for the top results of a search tool output."""
+    if PREFETCH_TOP_K <= 0:
+        return
+    try:
+        product_ids = [p["id"].strip() for p in json.loads(search_output)[:PREFETCH_TOP_K]
+                       if isinstance(p, dict) and isinstance(p.get("id"), str)]
+    except (ValueError, TypeError):
+        # An error message instead of results
+        return
+
+    with prefetch_lock:
+        expire_prefetches()
+        for product_id in product_ids:
+            if product_id in pending_prefetches:
+                continue
+            with tool_cache_lock:
+                if ("get_product_details", product_id) in tool_cache:
+                    continue
+            future = prefetch_executor.submit(fetch_product_details, product_id)
+            pending_prefetches[product_id] = (future, time.monotonic())
+            telemetry.tool_prefetches.labels("started").inc()
+
+
+def claim_prefetch(product_id: str):
+    """Returns the future of a pending, unexpired prefetch for this product, or None."""
+    with prefetch_lock:
+        expire_prefetches()
+        entry = pending_prefetches.pop(product_id.strip(), None)
+    return None if entry is None else entry[0]
+
+
+def wait_for_prefetch(future):
+    """Waits for a claimed prefetch and counts it as used, or as failed if its fetch raised."""
+    future.exception()
+    telemetry.tool_prefetches.labels("failed" if prefetch_failed(future) else "used").inc()
+
+
+if PREFETCH_TOP_K > 0:
+    threading.Thread(target=expire_prefetches_forever, name="prefetch-expiry", daemon=True).start()
+
+
+# --- CartService gRPC Channel ---
+# One channel per process, created lazily so that it is opened after gunicorn forks
+# its workers. Keepalive pings keep the idle connection from being silently dropped.
+CART_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+cart_channel = None
+cart_stub = None
+cart_channel_lock = threading.Lock()
+
+
+def get_cart_stub() -> demo_pb2_grpc.CartServiceStub:
+    """Returns the process-wide CartService stub, creating the channel on first use."""
+    global cart_channel, cart_stub
+    with cart_channel_lock:
+        if cart_stub is None:
+            cart_channel = grpc.insecure_channel(CART_SERVICE_ADDR, options=CART_CHANNEL_OPTIONS)
+            cart_stub = demo_pb2_grpc.CartServiceStub(cart_channel)
+        return cart_stub
+
+
+@atexit.register
+def close_cart_channel():
+    global cart_channel, cart_stub
+    with cart_channel_lock:
+        if cart_channel is not None:
+            cart_channel.close()
+        cart_channel = None
+        cart_stub = None
+
 
 # --- Tool Definition: Functions to interact with the catalog-reader ---
 
@@ -67,10 +354,15 @@ def search_products(query: str) -> str:
         A JSON string representing a list of products found.
     """
     print(f"TOOL: Searching for products with query: {query}")
+    output = search_catalog(query)
+    prefetch_product_details(output)
+    return output
+
+
+def search_catalog(query: str) -> str:
+    """search_products without the detail prefetch, for callers that won't ask for details."""
     try:
-        response = requests.post(f"{CATALOG_READER_URL}/products:search", json={"query": query})
-        response.raise_for_status()
-        return json.dumps(response.json())
+        return fetch_search_results(query)
     except requests.exceptions.RequestException as e:
         return f"Error searching for products: {e}"
 
@@ -86,9 +378,12 @@ def get_product_details(product_id: str) -> str:
     """
     print(f"TOOL: Getting details for product ID: {product_id}")
     try:
-        response = requests.get(f"{CATALOG_READER_URL}/products/{product_id}")
-        response.raise_for_status()
-        return json.dumps(response.json())
+        prefetch = claim_prefetch(product_id)
+        if prefetch is not None:
+            # Wait for it instead of fetching the same product twice. If it
+            # succeeded the lookup below is a cache hit, otherwise it tries again.
+            wait_for_prefetch(prefetch)
+        return fetch_product_details(product_id)
     except requests.exceptions.RequestException as e:
         return f"Error getting product details: {e}"
 
@@ -107,18 +402,14 @@ def add_item_to_cart(product_id: str, quantity: int) -> str:
     print(f"TOOL: Adding {quantity} of product {product_id} to cart for user {user_id}")
 
     try:
-        # Create a gRPC channel and stub for the cart service
-        channel = grpc.insecure_channel(CART_SERVICE_ADDR)
-        stub = demo_pb2_grpc.CartServiceStub(channel)
-
         # Create the request message
         request_message = demo_pb2.AddItemRequest(
             user_id=user_id,
-            item=demo_pb2.CartItem(product_id=product_id, quantity=quantity)
+            item=demo_pb2.CartItem(product_id=product_id, quantity=int(quantity))
         )
 
-        # Make the gRPC call
-        stub.AddItem(request_message)
+        # Make the gRPC call on the shared channel
+        get_cart_stub().AddItem(request_message, timeout=CART_RPC_TIMEOUT_SECONDS)
         print(f"TOOL: Successfully added item to cart.")
         return f"Successfully added {quantity} of product {product_id} to the cart."
     except grpc.RpcError as e:
@@ -128,6 +419,50 @@ def add_item_to_cart(product_id: str, quantity: int) -> str:
         print(f"TOOL ERROR: An unexpected error occurred: {e}")
         return f"Error: An unexpected error occurred while adding item to cart."
 
+def add_items_to_cart(product_ids: list[str], quantities: list[int]) -> str:
+    """
+    Adds several products to the user's shopping cart in one step.
+    Args:
+        product_ids: The IDs (SKUs) of the products to add.
+        quantities: The number of items to add for each product, in the same order as product_ids.
+    Returns:
+        A confirmation message string listing what was added and what failed.
+    """
+    user_id = request.json.get('userId', 'anonymous')
+    quantities = list(quantities) + [1] * (len(product_ids) - len(quantities))
+    print(f"TOOL: Adding {len(product_ids)} products to cart for user {user_id}")
+
+    try:
+        stub = get_cart_stub()
+        # Send all AddItem RPCs at once and then wait for them together
+        pending = [
+            (product_id, int(quantity), stub.AddItem.future(
+                demo_pb2.AddItemRequest(
+                    user_id=user_id,
+                    item=demo_pb2.CartItem(product_id=product_id, quantity=int(quantity))
+                ),
+                timeout=CART_RPC_TIMEOUT_SECONDS
+            ))
+            for product_id, quantity in zip(product_ids, quantities)
+        ]
+    except Exception as e:
+        print(f"TOOL ERROR: An unexpected error occurred: {e}")
+        return "Error: An unexpected error occurred while adding items to cart."
+
+    added, failed = [], []
+    for product_id, quantity, future in pending:
+        try:
+            future.result()
+            added.append(f"{quantity} of product {product_id}")
+        except grpc.RpcError as e:
+            print(f"TOOL ERROR: gRPC call to cartservice failed for {product_id}: {e.details()}")
+            failed.append(f"product {product_id} ({e.details()})")
+
+    message = f"Successfully added {', '.join(added)} to the cart." if added else "No items were added to the cart."
+    if failed:
+        message += f" Error: Could not add {', '.join(failed)}."
+    return message
+
 def add_to_watchlist(product_id: str) -> str:
     """
     Adds a product to the user's price drop watchlist.
@@ -141,7 +476,11 @@ def add_to_watchlist(product_id: str) -> str:
         return "Error: The promo agent is not configured, so I cannot add items to the watchlist."
 
     try:
-        response = requests.post(f"{PROMO_AGENT_URL}/watchlist", json={"product_id": product_id})
+        response = http_session.post(
+            f"{PROMO_AGENT_URL}/watchlist",
+            json={"product_id": product_id},
+            timeout=TOOL_HTTP_TIMEOUT_SECONDS
+        )
         response.raise_for_status()
         return f"Success! The product {product_id} has been added to your price drop watchlist."
     except requests.exceptions.RequestException as e:
@@ -171,6 +510,7 @@ You must respond with a valid JSON object and nothing else.
 # Cart Management
 - When the user asks to add an item to their cart, your goal is to call the `add_item_to_cart` tool.
 - The tool needs a `product_id` and a `quantity` (default to 1).
+- When the user asks to add several products at once, call `add_items_to_cart` a single time with all the `product_ids` and their `quantities`.
 - After the tool call, your final response MUST be a simple JSON object: `{"message": "Confirmation message from the tool"}`.
 
 # Watchlist Management
@@ -197,6 +537,7 @@ You must respond with a valid JSON object and nothing else.
 # Cart Management
 - When the user wants to add an item to their cart, use the `add_item_to_cart` tool.
 - It needs `product_id` and `quantity` (default 1).
+- Adding several products at once? Call `add_items_to_cart` one time with all the `product_ids` and `quantities`.
 - Your final response MUST be a simple JSON object: `{"message": "Confirmation message from the tool"}`.
 
 # Watchlist Management
@@ -205,71 +546,797 @@ You must respond with a valid JSON object and nothing else.
 - Your final response MUST be a simple JSON object: `{"message": "Confirmation message from the tool"}`.
 """
 
-@cached(reco_cache)
-def get_recommendation_from_model(user_query: str, variant: str) -> str:
-    """
-    Gets a recommendation from the Generative AI model.
-    This function is cached based on its arguments (user_query, variant).
-    """
-    print(f"CACHE MISS: Calling Generative AI model for query: '{user_query}', variant: '{variant}'")
+TOOLS = [search_products, get_product_details, add_item_to_cart, add_items_to_cart, add_to_watchlist]
+TOOLS_BY_NAME = {tool.__name__: tool for tool in TOOLS}
+
+# The variant comes from the client (the gateway passes ?variant= through) and ends up
+# in metric labels, cache keys and dispatch caps, so anything but a variant with a
+# prompt of its own is served as A.
+VARIANTS = ("A", "B")
+DEFAULT_VARIANT = "A"
+
+
+def normalize_variant(value) -> str:
+    variant = DEFAULT_VARIANT if value is None else str(value).strip().upper()
+    return variant if variant in VARIANTS else DEFAULT_VARIANT
+
+
+def build_model(variant: str, model_name: str = LARGE_MODEL_NAME) -> genai.GenerativeModel:
+    """Creates the Generative AI model configured with the system prompt for the given variant."""
     # Select the prompt based on the variant
     if variant == 'B':
         prompt = SYSTEM_PROMPT_B
     else:
         prompt = SYSTEM_PROMPT_A
 
-    # Initialize the model
-    model = genai.GenerativeModel(
-        model_name='gemini-1.5-pro-latest',
-        tools=[search_products, get_product_details, add_item_to_cart, add_to_watchlist],
+    return genai.GenerativeModel(
+        model_name=model_name,
+        tools=TOOLS,
         system_instruction=prompt,
         generation_config={"response_mime_type": "application/json"}
     )
-    chat = model.start_chat(enable_automatic_function_calling=True)
 
-    start_time = time.time()
-    response = chat.send_message(user_query)
-    end_time = time.time()
 
-    # Record the latency
-    latency_ms = (end_time - start_time) * 1000
-    llm_latency_metric.record(latency_ms)
-    print(f"METRIC: LLM latency: {latency_ms:.2f} ms")
+# --- Model Routing ---
+model_router = ModelRouter(FAST_MODEL_NAME, LARGE_MODEL_NAME, MODEL_COMPLEXITY_THRESHOLD, MODEL_ROUTING_OVERRIDES)
+
+
+def route_model(user_query: str, variant: str, history=None):
+    """Picks the model tier for a query and returns (tier, model name, model)."""
+    tier, model_name, score = model_router.route(user_query, variant, len(history or []) // 2)
+    telemetry.llm_routed.labels(variant, tier).inc()
+    print(f"ROUTER: Complexity {score} -> {tier} tier ({model_name}) for query: '{user_query}'")
+    return tier, model_name, build_model(variant, model_name)
+
+
+@contextmanager
+def observed_tier(tier: str):
+    """Records the latency of a whole model conversation, or its failure, for a model tier."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        telemetry.llm_tier_errors.labels(tier).inc()
+        raise
+    telemetry.llm_tier_latency.labels(tier).observe(time.perf_counter() - start_time)
+
+
+# --- Token Accounting ---
+# Usage metadata of every turn is added up per conversation and recorded per variant
+# and model: as counters and a cost counter, and as rolling-window gauges that a
+# background thread keeps current. Once the daily budget is used up, requests get
+# the fallback instead of a model call.
+token_usage = TokenUsage(LLM_DAILY_TOKEN_BUDGET, MODEL_PRICES, LLM_TOKEN_BUDGET_DIR)
+token_window_keys = set()
+token_window_lock = threading.Lock()
+
+
+class TokenBudgetExceeded(RuntimeError):
+    pass
+
+
+def check_token_budget(variant: str):
+    if token_usage.budget_exhausted():
+        telemetry.token_budget_exhausted.labels(variant).inc()
+        raise TokenBudgetExceeded(f"The daily budget of {LLM_DAILY_TOKEN_BUDGET} tokens is used up")
+
+
+def usage_of(response) -> tuple:
+    """Returns (prompt tokens, output tokens) from a response's usage metadata."""
+    usage = getattr(response, "usage_metadata", None)
+    return (getattr(usage, "prompt_token_count", 0) or 0, getattr(usage, "candidates_token_count", 0) or 0)
+
+
+def record_token_usage(variant: str, model_name: str, turn_usage: list):
+    """Records the (prompt, output) token counts of the turns of one conversation."""
+    if not turn_usage:
+        return
+    input_tokens = sum(prompt for prompt, _ in turn_usage)
+    output_tokens = sum(output for _, output in turn_usage)
+    tool_turn_tokens = sum(prompt + output for prompt, output in turn_usage[1:])
+    token_usage.record(variant, model_name, input_tokens, output_tokens, tool_turn_tokens)
+
+    for kind, tokens in zip(TOKEN_KINDS, (input_tokens, output_tokens, tool_turn_tokens)):
+        telemetry.llm_tokens.labels(variant, model_name, kind).inc(tokens)
+    telemetry.llm_request_tokens.labels(variant).observe(input_tokens + output_tokens)
+    cost = token_usage.cost(model_name, input_tokens, output_tokens)
+    telemetry.llm_cost.labels(variant, model_name).inc(cost)
+    print(f"METRIC: Tokens: {input_tokens} in, {output_tokens} out, {tool_turn_tokens} in tool turns, ${cost:.5f}")
+    refresh_token_windows()
+
+
+def refresh_token_windows():
+    totals = token_usage.window_totals()
+    with token_window_lock:
+        # Series that dropped out of every window go to zero once
+        for key in token_window_keys - totals.keys():
+            telemetry.llm_tokens_window.labels(*key).set(0)
+        for key, tokens in totals.items():
+            telemetry.llm_tokens_window.labels(*key).set(tokens)
+        token_window_keys.clear()
+        token_window_keys.update(totals.keys())
+    remaining = token_usage.budget_remaining()
+    if remaining is not None:
+        telemetry.llm_token_budget_remaining.set(remaining)
+
+
+def refresh_token_windows_forever():
+    while True:
+        time.sleep(TOKEN_WINDOW_REFRESH_SECONDS)
+        refresh_token_windows()
+
+
+threading.Thread(target=refresh_token_windows_forever, name="token-windows", daemon=True).start()
+
+
+# --- Function Calling ---
+# Instead of the SDK's automatic function calling, which runs the calls of a turn
+# one after another, the agent drives the loop itself. Calls returned in the same
+# model turn don't depend on each other, so they run concurrently on a bounded pool.
+TOOL_MAX_PARALLELISM = int(os.environ.get("TOOL_MAX_PARALLELISM", "8"))
+MAX_FUNCTION_CALLING_TURNS = int(os.environ.get("MAX_FUNCTION_CALLING_TURNS", "8"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_PARALLELISM, thread_name_prefix="tool")
+
+
+def call_tool(function_call) -> str:
+    tool = TOOLS_BY_NAME.get(function_call.name)
+    if tool is None:
+        return f"Error: Unknown tool '{function_call.name}'."
+    # A failing tool is reported to the model like an unknown one, so it can recover
+    try:
+        with telemetry.tool_call_latency.labels(function_call.name).time():
+            return tool(**dict(function_call.args))
+    except Exception as e:
+        telemetry.tool_call_errors.labels(function_call.name).inc()
+        print(f"TOOL ERROR: {function_call.name} failed: {e!r}")
+        return f"Error: Tool '{function_call.name}' failed: {e}"
+
+
+def execute_function_calls(function_calls: list) -> list:
+    """
+    Runs the function calls of one model turn concurrently and returns the
+    function responses in the order the calls were made.
+    """
+    # Each call gets its own copy of the context so the tools can still see the Flask request.
+    futures = [
+        tool_executor.submit(contextvars.copy_context().run, call_tool, function_call)
+        for function_call in function_calls
+    ]
+    return [
+        glm.Part(function_response=glm.FunctionResponse(
+            name=function_call.name,
+            response={"result": future.result()}
+        ))
+        for function_call, future in zip(function_calls, futures)
+    ]
+
+
+def function_calls_in(response) -> list:
+    return [part.function_call for part in response.candidates[0].content.parts if part.function_call]
+
+
+def record_turn_timing(turn: int, llm_ms: float, tool_ms: float, num_calls: int):
+    telemetry.llm_turn_latency.labels(str(turn)).observe(llm_ms / 1000)
+    if num_calls:
+        telemetry.tool_turn_latency.observe(tool_ms / 1000)
+    print(f"METRIC: Turn {turn}: LLM {llm_ms:.2f} ms, {num_calls} tool calls {tool_ms:.2f} ms")
+
+
+# --- Model Call Dispatch ---
+# Every model turn takes a slot from the dispatcher, which caps the calls in flight
+# globally and per variant and lets users take turns when calls have to wait.
+# A call rejected for exhausted quota gives its slot back, backs off briefly and
+# queues again, instead of failing the request.
+dispatcher = FairDispatcher(LLM_MAX_IN_FLIGHT, LLM_VARIANT_CAPS, LLM_USER_WEIGHTS)
 
-    return response.text
+
+def current_user_id() -> str:
+    if has_request_context() and request.is_json:
+        return str((request.get_json(silent=True) or {}).get('userId', 'anonymous'))
+    return 'anonymous'
+
+
+@contextmanager
+def model_slot(user_id: str, variant: str):
+    telemetry.llm_queue_depth.labels(variant).inc()
+    try:
+        waited = dispatcher.acquire(user_id, variant, LLM_QUEUE_TIMEOUT_SECONDS)
+    except DispatchTimeout:
+        telemetry.llm_queue_timeouts.labels(variant).inc()
+        raise
+    finally:
+        telemetry.llm_queue_depth.labels(variant).dec()
+    telemetry.llm_queue_wait.labels(variant).observe(waited)
+    if waited >= 0.1:
+        print(f"METRIC: Waited {waited * 1000:.2f} ms for a model slot (user {user_id}, variant {variant})")
+    telemetry.llm_in_flight.labels(variant).inc()
+    try:
+        yield
+    finally:
+        telemetry.llm_in_flight.labels(variant).dec()
+        dispatcher.release(variant)
+
+
+def quota_backoff(variant: str, attempt: int, error):
+    """Sleeps before a quota-rejected call queues again, or re-raises once retries are used up."""
+    if attempt >= LLM_QUOTA_RETRIES:
+        raise error
+    telemetry.llm_quota_retries.labels(variant).inc()
+    delay = LLM_QUOTA_BACKOFF_SECONDS * 2 ** attempt
+    print(f"QUOTA: Model quota exhausted (variant {variant}), queueing again in {delay:.2f}s")
+    time.sleep(delay)
+
+
+# A conversation answering a request that bypasses the cache carries the request's
+# deadline. Once it has passed nobody waits for the answer, so no further model call
+# or tool (which may change the cart) is started for it.
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class RequestDeadlineExceeded(RuntimeError):
+    pass
+
+
+def check_request_deadline():
+    deadline = request_deadline.get()
+    if deadline is not None and time.monotonic() >= deadline:
+        raise RequestDeadlineExceeded("The request's latency budget ran out")
+
+
+def model_call_timeout() -> float:
+    check_request_deadline()
+    deadline = request_deadline.get()
+    if deadline is None:
+        return LLM_CALL_TIMEOUT_SECONDS
+    return min(LLM_CALL_TIMEOUT_SECONDS, deadline - time.monotonic())
+
+
+def send_to_model(chat, message, variant: str):
+    user_id = current_user_id()
+    for attempt in range(LLM_QUOTA_RETRIES + 1):
+        try:
+            with model_slot(user_id, variant):
+                return chat.send_message(message, request_options={"timeout": model_call_timeout()})
+        except ResourceExhausted as e:
+            quota_backoff(variant, attempt, e)
+
+
+def stream_from_model(chat, message, variant: str):
+    """Like send_to_model, but yields streamed chunks and holds the slot until the stream ends."""
+    user_id = current_user_id()
+    for attempt in range(LLM_QUOTA_RETRIES + 1):
+        started = False
+        try:
+            with model_slot(user_id, variant):
+                for chunk in chat.send_message(message, stream=True, request_options={"timeout": model_call_timeout()}):
+                    started = True
+                    yield chunk
+            return
+        except ResourceExhausted as e:
+            # Chunks already handed out can't be taken back
+            if started:
+                raise
+            quota_backoff(variant, attempt, e)
+
+
+def generate_recommendation(user_query: str, variant: str, history=None) -> bytes:
+    """
+    Gets a recommendation from the Generative AI model as validated, serialized JSON,
+    continuing the given chat history if there is one. Not cached.
+    """
+    check_token_budget(variant)
+    tier, model_name, model = route_model(user_query, variant, history)
+    with observed_tier(tier):
+        chat = model.start_chat(history=history or [])
+
+        start_time = time.time()
+        message = user_query
+        turn_usage = []
+        tool_calls = 0
+        try:
+            for turn in range(MAX_FUNCTION_CALLING_TURNS):
+                turn_start = time.time()
+                response = send_to_model(chat, message, variant)
+                llm_ms = (time.time() - turn_start) * 1000
+                turn_usage.append(usage_of(response))
+
+                function_calls = function_calls_in(response)
+                tool_start = time.time()
+                if function_calls:
+                    check_request_deadline()
+                    message = execute_function_calls(function_calls)
+                record_turn_timing(turn, llm_ms, (time.time() - tool_start) * 1000, len(function_calls))
+                tool_calls += len(function_calls)
+                if not function_calls:
+                    break
+            else:
+                raise RuntimeError(f"Model did not finish within {MAX_FUNCTION_CALLING_TURNS} function calling turns")
+        finally:
+            # Tokens are spent even if the conversation fails
+            record_token_usage(variant, model_name, turn_usage)
+        experiment_stats.record(variant, "tool_calls", tool_calls)
+
+        # Record the latency
+        latency_ms = (time.time() - start_time) * 1000
+        telemetry.llm_latency.labels(variant).observe(latency_ms / 1000)
+        print(f"METRIC: LLM latency: {latency_ms:.2f} ms")
+
+        try:
+            with telemetry.json_parse_latency.time():
+                return serialize_response(parse_model_response(response.text))
+        except ModelResponseError as e:
+            telemetry.parse_failures.labels(variant).inc()
+            raise ModelResponseError(f"{e}. Raw Response: '{response.text}'") from e
+
+
+def get_recommendation_from_model(user_query: str, variant: str) -> bytes:
+    """
+    Gets a recommendation from the Generative AI model as validated, serialized JSON.
+    A fresh cache entry for (user_query, variant) is returned as-is; otherwise the
+    model is called and the result cached. Since invalid model output raises
+    ModelResponseError, it never enters the cache.
+    """
+    key = reco_cache_key(user_query, variant)
+    entry = reco_cache.get(key)
+    if entry is not None and reco_cache.is_fresh(entry):
+        return entry.value
+    print(f"CACHE MISS: Calling Generative AI model for query: '{user_query}', variant: '{variant}'")
+    response_body = generate_recommendation(user_query, variant)
+    reco_cache[key] = response_body
+    return response_body
+
+
+def stream_recommendation_from_model(user_query: str, variant: str, history=None):
+    """
+    Streams the model's answer as it is generated, yielding text chunks.
+    Function calls are handled by the same loop as generate_recommendation.
+    """
+    print(f"CACHE MISS: Streaming Generative AI model for query: '{user_query}', variant: '{variant}'")
+    tier, model_name, model = route_model(user_query, variant, history)
+    with observed_tier(tier):
+        chat = model.start_chat(history=history or [])
+
+        start_time = time.time()
+        first_chunk = True
+        message = user_query
+        turn_usage = []
+        tool_calls = 0
+        try:
+            for turn in range(MAX_FUNCTION_CALLING_TURNS):
+                turn_start = time.time()
+                function_calls = []
+                # The last chunk of a turn carries the usage of the whole turn
+                usage = (0, 0)
+                for chunk in stream_from_model(chat, message, variant):
+                    usage = usage_of(chunk)
+                    for part in chunk.candidates[0].content.parts:
+                        if part.function_call:
+                            function_calls.append(part.function_call)
+                        elif part.text:
+                            if first_chunk:
+                                first_chunk = False
+                                first_chunk_ms = (time.time() - start_time) * 1000
+                                telemetry.llm_first_chunk_latency.observe(first_chunk_ms / 1000)
+                                print(f"METRIC: LLM time to first chunk: {first_chunk_ms:.2f} ms")
+                            yield part.text
+                llm_ms = (time.time() - turn_start) * 1000
+                turn_usage.append(usage)
+
+                tool_start = time.time()
+                if function_calls:
+                    check_request_deadline()
+                    message = execute_function_calls(function_calls)
+                record_turn_timing(turn, llm_ms, (time.time() - tool_start) * 1000, len(function_calls))
+                tool_calls += len(function_calls)
+                if not function_calls:
+                    break
+            else:
+                raise RuntimeError(f"Model did not finish within {MAX_FUNCTION_CALLING_TURNS} function calling turns")
+        finally:
+            record_token_usage(variant, model_name, turn_usage)
+        experiment_stats.record(variant, "tool_calls", tool_calls)
+
+        latency_ms = (time.time() - start_time) * 1000
+        telemetry.llm_latency.labels(variant).observe(latency_ms / 1000)
+        print(f"METRIC: LLM latency: {latency_ms:.2f} ms")
+
+
+def ndjson_line(payload: dict) -> str:
+    return json.dumps(payload) + "\n"
+
+
+def stream_recommendation(user_query: str, variant: str, user_id=None, history=None):
+    """
+    Generator behind /recommend?stream=1. Emits newline-delimited JSON events:
+    one {"type": "suggestion"} event per suggestion as soon as it is complete,
+    then a final {"type": "result"} event with the whole response object.
+    The full model text populates the cache once the stream has finished,
+    unless the query bypasses the cache (see bypasses_cache).
+    """
+    start_time = time.perf_counter()
+    cache_key = reco_cache_key(user_query, variant)
+    bypass = bypasses_cache(user_query, history)
+    entry = None if bypass else lookup_cached_recommendation(user_query, variant)
+    cached_body = None
+    if entry is not None:
+        telemetry.cache_hits.labels(variant).inc()
+        cached_body = entry.value
+        if cached_recommendation_status(user_query, variant, entry) == "stale":
+            cached_body = flag_stale(cached_body)
+        chunks = [cached_body.decode("utf-8")]
+    elif token_usage.budget_exhausted():
+        telemetry.token_budget_exhausted.labels(variant).inc()
+        telemetry.fallbacks.labels(variant).inc()
+        print(f"BUDGET EXCEEDED: Daily token budget used up, serving fallback for '{user_query}'")
+        result_line = ndjson_line({"type": "result", "response": fallback_recommendation(user_query)})
+        yield result_line
+        telemetry.request_latency.labels(variant, "fallback").observe(time.perf_counter() - start_time)
+        record_experiment_request(variant, time.perf_counter() - start_time, len(result_line))
+        return
+    else:
+        telemetry.cache_misses.labels(variant).inc()
+        chunks = stream_recommendation_from_model(user_query, variant, history)
+
+    parser = SuggestionStreamParser()
+    try:
+        for chunk in chunks:
+            for suggestion in parser.feed(chunk):
+                yield ndjson_line({"type": "suggestion", "suggestion": suggestion})
+        with telemetry.json_parse_latency.time():
+            final_json_response = parse_model_response(parser.text)
+    except Exception as e:
+        if isinstance(e, ModelResponseError):
+            telemetry.parse_failures.labels(variant).inc()
+        error_message = f"Failed to stream a valid JSON response from the model or cache. Error: {e}. Raw Response: '{parser.text}'"
+        print(f"API ERROR: {error_message}")
+        yield ndjson_line({"type": "error", "error": error_message})
+        telemetry.request_latency.labels(variant, "error").observe(time.perf_counter() - start_time)
+        return
+
+    response_body = serialize_response(final_json_response)
+    if cached_body is None and not bypass:
+        reco_cache[cache_key] = response_body
+    record_session_exchange(user_id, user_query, response_body)
+    yield ndjson_line({"type": "result", "response": final_json_response})
+    telemetry.request_latency.labels(variant, "stream").observe(time.perf_counter() - start_time)
+    record_experiment_request(variant, time.perf_counter() - start_time, len(response_body))
+
+
+# --- Chat Sessions ---
+# Follow-up questions ("add the second one") are answered with the user's recent
+# history. Their answers depend on the conversation, so they bypass the cache;
+# other queries keep using it and are only recorded into the session.
+session_store = ChatSessionStore(
+    max_sessions=SESSION_MAX_USERS,
+    idle_timeout=SESSION_IDLE_TIMEOUT_SECONDS,
+    token_budget=SESSION_TOKEN_BUDGET,
+    memory_cap_bytes=SESSION_MEMORY_CAP_BYTES,
+)
+
+
+def conversation_history(user_id, user_query: str) -> list:
+    """Returns the history to answer this query with, or [] if it can be answered on its own."""
+    if not user_id or not is_follow_up(user_query):
+        return []
+    return session_store.history(user_id)
+
+
+def record_session_exchange(user_id, user_query: str, response_body: bytes):
+    if not user_id:
+        return
+    session_store.record_exchange(user_id, user_query, response_body.decode("utf-8"))
+    refresh_session_gauges()
+
+
+def refresh_session_gauges():
+    telemetry.chat_sessions.set(len(session_store))
+    telemetry.chat_session_memory.set(session_store.memory_bytes)
+
+
+def refresh_session_gauges_forever():
+    # Idle sessions expire even when nobody makes a request, so don't wait for one
+    while True:
+        time.sleep(SESSION_GAUGE_REFRESH_SECONDS)
+        session_store.expire()
+        refresh_session_gauges()
+
+
+threading.Thread(target=refresh_session_gauges_forever, name="session-gauges", daemon=True).start()
+
+
+# --- Latency Budget & Fallback ---
+# Model calls run on a background pool so /recommend can stop waiting when its
+# budget runs out. The call keeps going and fills the cache for the next request;
+# concurrent requests for the same query share one in-flight call.
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+inflight_recommendations = {}
+inflight_lock = threading.Lock()
+
+FALLBACK_STOP_WORDS = {
+    "a", "an", "and", "any", "are", "can", "do", "find", "for", "from", "get", "have", "i", "in",
+    "is", "looking", "me", "my", "need", "of", "on", "or", "please", "show", "some", "something",
+    "that", "the", "to", "want", "what", "with", "you",
+}
+FALLBACK_MAX_KEYWORDS = 4
+FALLBACK_MAX_SUGGESTIONS = 3
+
+
+def bypasses_cache(user_query: str, history) -> bool:
+    """
+    Follow-ups depend on the conversation and action intents ("add the mug to my
+    cart") change state, so neither may be answered from the cache, share an
+    in-flight call with another user, or be replayed by a background refresh.
+    """
+    return bool(history) or is_action_intent(user_query)
+
+
+def lookup_cached_recommendation(user_query: str, variant: str):
+    """Returns the CacheEntry for this query, fresh or stale, or None."""
+    with telemetry.cache_lookup_latency.time():
+        return reco_cache.get(reco_cache_key(user_query, variant))
+
+
+def submit_recommendation(user_query: str, variant: str):
+    """Starts (or joins) the model call for this query and returns its future."""
+    key = reco_cache_key(user_query, variant)
+    with inflight_lock:
+        future = inflight_recommendations.get(key)
+        if future is None:
+            future = llm_executor.submit(
+                contextvars.copy_context().run, get_recommendation_from_model, user_query, variant
+            )
+            inflight_recommendations[key] = future
+            future.add_done_callback(lambda _: inflight_recommendations.pop(key, None))
+    return future
+
+
+def refresh_recommendation(user_query: str, variant: str):
+    """Refreshes a stale cache entry in the background; if that fails, the entry is marked."""
+    key = reco_cache_key(user_query, variant)
+    with inflight_lock:
+        if key in inflight_recommendations:
+            return
+    future = submit_recommendation(user_query, variant)
+    future.add_done_callback(lambda f: f.exception() is not None and reco_cache.mark_refresh_failed(key))
+
+
+def cached_recommendation_status(user_query: str, variant: str, entry) -> str:
+    """
+    Returns how a cache entry is served: "hit" while it is fresh, "revalidate" while a
+    background refresh is started for it, and "stale" once refreshing it has failed.
+    """
+    if reco_cache.is_fresh(entry):
+        return "hit"
+    refresh_recommendation(user_query, variant)
+    if entry.refresh_failed:
+        print(f"STALE: Model refresh failed for '{user_query}', serving a {entry.age():.0f}s old answer")
+        telemetry.stale_served.labels(variant, "error").inc()
+        return "stale"
+    telemetry.stale_served.labels(variant, "revalidate").inc()
+    return "revalidate"
+
+
+def flag_stale(response_body: bytes) -> bytes:
+    return serialize_response({**json.loads(response_body), "stale": True})
+
+
+def request_budget_seconds() -> float:
+    budget = RECOMMEND_LATENCY_BUDGET_SECONDS
+    deadline_ms = request.headers.get(DEADLINE_HEADER)
+    if deadline_ms:
+        try:
+            budget = min(budget, max(float(deadline_ms) / 1000, 0))
+        except ValueError:
+            pass
+    return budget
+
+
+def fallback_recommendation(user_query: str, timeout=None) -> dict:
+    """
+    Builds a degraded answer without the model: the query's keywords are searched
+    in the catalog and products matching the most keywords are suggested. Searches
+    not done within timeout seconds are left out (and still fill the tool cache).
+    """
+    keywords = [w for w in "".join(c if c.isalnum() else " " for c in user_query.lower()).split()
+                if w not in FALLBACK_STOP_WORDS][:FALLBACK_MAX_KEYWORDS]
+    searches = [tool_executor.submit(search_catalog, keyword) for keyword in keywords]
+    done, _ = wait(searches, timeout=timeout)
+    matches = {}
+    for keyword, search in zip(keywords, searches):
+        if search not in done:
+            continue
+        try:
+            products = json.loads(search.result())
+        except json.JSONDecodeError:
+            continue
+        for product in products:
+            entry = matches.setdefault(product["id"], {"product": product, "keywords": []})
+            entry["keywords"].append(keyword)
+
+    ranked = sorted(matches.values(), key=lambda m: len(m["keywords"]), reverse=True)[:FALLBACK_MAX_SUGGESTIONS]
+    return {
+        "suggestions": [
+            {
+                "id": m["product"]["id"],
+                "name": m["product"].get("name", ""),
+                "why": f"Matches your search for {', '.join(m['keywords'])}.",
+            }
+            for m in ranked
+        ],
+        "compare": "",
+        "message": "Our assistant is taking longer than usual, so here are some quick matches from the catalog.",
+        "fallback": True,
+    }
+
+
+# Actions are never answered with the keyword fallback: it would hide whether the
+# cart or watchlist was changed
+ACTION_TIMEOUT_RESPONSE = {
+    "message": "We couldn't confirm your request in time. Please check your cart or watchlist before trying again.",
+    "timeout": True,
+}
 
 
 # --- Flask API Endpoint ---
 
 @app.route('/recommend', methods=['POST'])
 def recommend():
-    data = request.get_json()
-    if not data or 'query' not in data:
-        return jsonify({"error": "Request body must be JSON with a 'query' field."}), 400
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('query'), str) or not data['query'].strip():
+        return jsonify({"error": "Request body must be JSON with a non-empty string 'query' field."}), 400
 
     user_query = data['query']
-    variant = data.get('variant', 'A').upper()
+    variant = normalize_variant(data.get('variant'))
+    # Anonymous requests don't get a session, they would all share one
+    user_id = data.get('userId') if data.get('userId') != 'anonymous' else None
+    history = conversation_history(user_id, user_query)
 
-    try:
-        # Get the recommendation, potentially from the cache
-        response_text = get_recommendation_from_model(user_query, variant)
+    if request.args.get('stream') in ('1', 'true'):
+        return Response(
+            stream_with_context(stream_recommendation(user_query, variant, user_id, history)),
+            mimetype='application/x-ndjson'
+        )
 
-        # The model is in JSON mode, but as a fallback, strip markdown and find the JSON object.
-        response_text_cleaned = response_text.strip().replace("```json", "").replace("```", "")
-        json_start = response_text_cleaned.find('{')
-        json_end = response_text_cleaned.rfind('}') + 1
+    start_time = time.perf_counter()
+    budget = request_budget_seconds()
+    deadline = time.monotonic() + budget
+    action = is_action_intent(user_query)
+    # Everything else has to leave time for the fallback
+    model_deadline = deadline if action else deadline - min(FALLBACK_RESERVE_SECONDS, budget / 2)
 
-        if json_start == -1 or json_end == 0:
-             raise json.JSONDecodeError("No JSON object found in response", response_text_cleaned, 0)
+    def observed(response, outcome):
+        elapsed = time.perf_counter() - start_time
+        telemetry.request_latency.labels(variant, outcome).observe(elapsed)
+        if outcome != "error":
+            record_experiment_request(variant, elapsed, len(response.get_data()))
+        return response
 
-        json_str = response_text_cleaned[json_start:json_end]
-        final_json_response = json.loads(json_str)
-        return jsonify(final_json_response)
+    # Cached entries are already validated and serialized, so they are written out as-is.
+    # The X-Cache header tells clients (and the benchmark harness) how a request was served.
+    bypass = bypasses_cache(user_query, history)
+    if not bypass:
+        entry = lookup_cached_recommendation(user_query, variant)
+        if entry is not None:
+            telemetry.cache_hits.labels(variant).inc()
+            cache_status = cached_recommendation_status(user_query, variant, entry)
+            response_body = flag_stale(entry.value) if cache_status == "stale" else entry.value
+            record_session_exchange(user_id, user_query, entry.value)
+            return observed(Response(response_body, mimetype='application/json', headers={"X-Cache": cache_status}), cache_status)
+        telemetry.cache_misses.labels(variant).inc()
+
+    try:
+        # Get the recommendation from the model within the latency budget
+        if bypass:
+            context = contextvars.copy_context()
+            context.run(request_deadline.set, model_deadline)
+            future = llm_executor.submit(context.run, generate_recommendation, user_query, variant, history)
+        else:
+            future = submit_recommendation(user_query, variant)
+        try:
+            response_body = future.result(timeout=max(0.0, model_deadline - time.monotonic()))
+        except (FutureTimeoutError, RequestDeadlineExceeded, DeadlineExceeded, DispatchTimeout, TokenBudgetExceeded) as e:
+            if isinstance(e, TokenBudgetExceeded):
+                print(f"BUDGET EXCEEDED: {e}, for '{user_query}'")
+            else:
+                print(f"BUDGET EXCEEDED: No model response for '{user_query}' within {budget:.2f}s")
+            if action:
+                response = jsonify(ACTION_TIMEOUT_RESPONSE)
+                response.headers["X-Cache"] = "timeout"
+                return observed(response, "timeout")
+            telemetry.fallbacks.labels(variant).inc()
+            response = jsonify(fallback_recommendation(user_query, max(0.0, deadline - time.monotonic())))
+            response.headers["X-Cache"] = "fallback"
+            return observed(response, "fallback")
+        record_session_exchange(user_id, user_query, response_body)
+        cache_status = "bypass" if bypass else "miss"
+        return observed(Response(response_body, mimetype='application/json', headers={"X-Cache": cache_status}), cache_status)
 
-    except (json.JSONDecodeError, Exception) as e:
-        error_message = f"Failed to get a valid JSON response from the model or cache. Error: {e}. Raw Response: '{response_text}'"
+    except Exception as e:
+        error_message = f"Failed to get a valid JSON response from the model or cache. Error: {e}"
         print(f"API ERROR: {error_message}")
-        return jsonify({"error": error_message}), 500
+        return observed((jsonify({"error": error_message}), 500), "error")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    refresh_token_windows()
+    body, content_type = telemetry.render_metrics()
+    return Response(body, headers={"Content-Type": content_type})
+
+# --- Experiment Analytics ---
+# Quantile sketches per variant (see experiments.py). Workers flush their sketches
+# to a shared directory, so every worker can answer for the whole pod.
+EXPERIMENT_STATS_DIR = os.environ.get("EXPERIMENT_STATS_DIR") or (
+    os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "experiments")
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR") else None
+)
+EXPERIMENT_FLUSH_SECONDS = float(os.environ.get("EXPERIMENT_FLUSH_SECONDS", "10"))
+experiment_stats = ExperimentStats(state_dir=EXPERIMENT_STATS_DIR, variants=VARIANTS)
+
+
+def record_experiment_request(variant: str, latency_seconds: float, response_bytes: int):
+    experiment_stats.record(variant, "latency_ms", latency_seconds * 1000)
+    experiment_stats.record(variant, "response_bytes", response_bytes)
+
+
+def flush_experiment_stats_forever():
+    while True:
+        time.sleep(EXPERIMENT_FLUSH_SECONDS)
+        try:
+            experiment_stats.flush()
+        except OSError as e:
+            print(f"API ERROR: Could not write experiment stats: {e}")
+
+
+threading.Thread(target=flush_experiment_stats_forever, name="experiment-stats", daemon=True).start()
+
+
+@app.route('/experiments/stats', methods=['GET'])
+def experiments_stats():
+    """Quantiles per variant for the pod; ?sketches=1 adds the sketches for merging across pods."""
+    sketches = experiment_stats.merged()
+    stats = {"variants": summarize(sketches)}
+    if request.args.get('sketches') in ('1', 'true'):
+        stats["sketches"] = serialize_sketches(sketches)
+    return jsonify(stats)
+
+
+# --- Cache Warm-up & Readiness ---
+warmup_done = threading.Event()
+
+
+def warm_recommendation(user_query: str, variant: str):
+    # Tools read the user from the request, so the model call runs in a synthetic one
+    with app.test_request_context('/recommend', method='POST',
+                                  json={"query": user_query, "variant": variant, "userId": "warmup"}):
+        get_recommendation_from_model(user_query, variant)
+
+
+def run_warmup():
+    try:
+        start_time = time.time()
+        entries = [(query, normalize_variant(variant)) for query, variant in load_query_log(WARMUP_QUERY_LOG)]
+        ranked = warmup.rank_queries(entries, WARMUP_TOP_N, query_normalizer.normalize)
+        stats = warmup.warm_cache(warm_recommendation, ranked, WARMUP_CONCURRENCY, WARMUP_MAX_RPS, WARMUP_TIMEOUT_SECONDS)
+        print(f"WARMUP: Finished in {time.time() - start_time:.1f}s: {stats}")
+    except Exception as e:
+        print(f"WARMUP: Cache warm-up failed, starting cold. Error: {e}")
+    finally:
+        warmup_done.set()
+
+
+if WARMUP_QUERY_LOG:
+    threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+else:
+    warmup_done.set()
+
+
+@app.route('/healthz/ready', methods=['GET'])
+def ready():
+    if not warmup_done.is_set():
+        return jsonify({"status": "warming up"}), 503
+    return jsonify({"status": "ready"})
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
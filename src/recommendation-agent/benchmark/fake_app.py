@@ -0,0 +1,11 @@
+"""
+WSGI entry point for benchmarking: the real app with the fake Gemini SDK.
+
+    gunicorn --chdir src/recommendation-agent benchmark.fake_app:app
+"""
+
+from benchmark import fake_genai
+
+fake_genai.install()
+
+from app import app
@@ -0,0 +1,257 @@
+"""
+Deterministic stand-in for `google.generativeai`, used by the benchmark harness.
+
+install() registers fake `google.generativeai` and `google.ai.generativelanguage`
+modules in sys.modules (and `google.api_core.exceptions` if it isn't installed),
+so app.py can be imported unchanged without spending any Gemini quota. The fake
+model follows a tool-call script and then answers with a suggestions JSON built
+from the tool results, sleeping for each turn according to a configurable
+latency distribution.
+
+Configuration (environment variables):
+    FAKE_LLM_LATENCY   Per-turn latency distribution in ms:
+                       "fixed:<ms>", "uniform:<lo>:<hi>" or "lognormal:<median>:<sigma>".
+                       Default "lognormal:800:0.4".
+    FAKE_LLM_SCRIPT    Path to a JSON tool-call script (see DEFAULT_SCRIPT). Inside call
+                       arguments, "$query" is replaced by the user query and "$result_id"
+                       expands the call once per product id from the last search (up to
+                       the call's "limit").
+    FAKE_LLM_SEED      Seed for the latency generator. Latencies are derived from the seed
+                       and the query, so a run can be replayed exactly.
+"""
+
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+import types
+
+DEFAULT_SCRIPT = [
+    [{"name": "search_products", "args": {"query": "$query"}}],
+    [{"name": "get_product_details", "args": {"product_id": "$result_id"}, "limit": 2}],
+]
+
+STREAM_CHUNK_CHARS = 24
+
+
+def parse_latency(spec: str):
+    """Returns a function rng -> latency in seconds for a FAKE_LLM_LATENCY spec."""
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda rng: params[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(params[0], params[1]) / 1000
+    if kind == "lognormal":
+        median, sigma = params
+        return lambda rng: rng.lognormvariate(math.log(median), sigma) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+LATENCY = parse_latency(os.environ.get("FAKE_LLM_LATENCY", "lognormal:800:0.4"))
+SEED = os.environ.get("FAKE_LLM_SEED", "0")
+if os.environ.get("FAKE_LLM_SCRIPT"):
+    with open(os.environ["FAKE_LLM_SCRIPT"]) as f:
+        SCRIPT = json.load(f)
+else:
+    SCRIPT = DEFAULT_SCRIPT
+
+
+# --- google.ai.generativelanguage stand-ins ---
+
+class ResourceExhausted(Exception):
+    """Stand-in for google.api_core.exceptions.ResourceExhausted (HTTP 429)."""
+
+
+class DeadlineExceeded(Exception):
+    """Stand-in for google.api_core.exceptions.DeadlineExceeded (HTTP 504)."""
+
+
+class FunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+class FunctionResponse:
+    def __init__(self, name, response):
+        self.name = name
+        self.response = response
+
+
+class Part:
+    def __init__(self, text="", function_call=None, function_response=None):
+        self.text = text
+        self.function_call = function_call
+        self.function_response = function_response
+
+
+class Content:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+class Candidate:
+    def __init__(self, parts):
+        self.content = Content(parts)
+
+
+class UsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class GenerateContentResponse:
+    def __init__(self, parts, prompt_tokens=0, output_chars=None):
+        self.candidates = [Candidate(parts)]
+        self.text = "".join(p.text for p in parts)
+        # Like the real API, streamed chunks report the output generated so far
+        output_chars = len(self.text) if output_chars is None else output_chars
+        self.usage_metadata = UsageMetadata(prompt_tokens, (output_chars + 3) // 4)
+
+
+# --- google.generativeai stand-ins ---
+
+class ChatSession:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+        self._turn = 0
+        self._query = None
+        self._results = []
+        self._rng = None
+
+    def _expand(self, call):
+        args = {k: self._query if v == "$query" else v for k, v in call["args"].items()}
+        if "$result_id" not in args.values():
+            return [FunctionCall(call["name"], args)]
+        ids = [p["id"] for p in self._results[:call.get("limit", len(self._results))]]
+        return [
+            FunctionCall(call["name"], {k: (pid if v == "$result_id" else v) for k, v in args.items()})
+            for pid in ids
+        ]
+
+    def _answer(self) -> str:
+        if not self._results:
+            return json.dumps({"message": f"I could not find anything for '{self._query}'."})
+        return json.dumps({
+            "suggestions": [
+                {"id": p["id"], "name": p.get("name", ""), "why": f"A great match for '{self._query}'."}
+                for p in self._results[:3]
+            ],
+            "compare": "All of these are popular picks.",
+        })
+
+    def _next_parts(self, content):
+        if isinstance(content, str):
+            self._query = content
+            self._turn = 0
+            self._results = []
+            digest = hashlib.sha256(f"{SEED}:{content}".encode()).hexdigest()
+            self._rng = random.Random(int(digest[:16], 16))
+        else:
+            for part in content:
+                response = part.function_response
+                if response is not None and response.name == "search_products":
+                    try:
+                        self._results = json.loads(response.response["result"])
+                    except (TypeError, ValueError):
+                        self._results = []
+
+        while self._turn < len(SCRIPT):
+            calls = [c for call in SCRIPT[self._turn] for c in self._expand(call)]
+            self._turn += 1
+            if calls:
+                return [Part(function_call=c) for c in calls]
+        return [Part(text=self._answer())]
+
+    def send_message(self, content, stream=False, **kwargs):
+        prompt_tokens = (len(json.dumps(content, default=lambda o: vars(o))) + 3) // 4
+        self.history.append(content)
+        parts = self._next_parts(content)
+        latency = LATENCY(self._rng)
+        timeout = (kwargs.get("request_options") or {}).get("timeout")
+        if not stream:
+            if timeout is not None and latency > timeout:
+                time.sleep(max(0, timeout))
+                raise DeadlineExceeded(f"Model call exceeded its {timeout:.2f}s timeout")
+            time.sleep(latency)
+            return GenerateContentResponse(parts, prompt_tokens)
+        return self._stream(parts, latency, prompt_tokens)
+
+    def _stream(self, parts, latency, prompt_tokens):
+        # Roughly a third of the turn passes before the first chunk, the rest is spread over the chunks
+        time.sleep(latency * 0.3)
+        if parts[0].function_call is not None:
+            time.sleep(latency * 0.7)
+            yield GenerateContentResponse(parts, prompt_tokens)
+            return
+        text = parts[0].text
+        chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        for i, chunk in enumerate(chunks):
+            yield GenerateContentResponse([Part(text=chunk)], prompt_tokens, min(len(text), (i + 1) * STREAM_CHUNK_CHARS))
+            time.sleep(latency * 0.7 / len(chunks))
+
+
+class GenerativeModel:
+    def __init__(self, model_name, tools=None, system_instruction=None, generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.tools = tools
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+
+    def start_chat(self, history=None, **kwargs):
+        return ChatSession(self, history)
+
+
+def configure(**kwargs):
+    pass
+
+
+def install():
+    """Registers the fake SDK modules so that `import google.generativeai` resolves to them."""
+    # `google` is a namespace package shared with protobuf, so extend it rather than replace it
+    try:
+        import google
+    except ImportError:
+        google = types.ModuleType("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    ai = sys.modules.get("google.ai")
+    if ai is None:
+        ai = types.ModuleType("google.ai")
+        ai.__path__ = []
+
+    genai = types.ModuleType("google.generativeai")
+    genai.configure = configure
+    genai.GenerativeModel = GenerativeModel
+    glm = types.ModuleType("google.ai.generativelanguage")
+    glm.Part = Part
+    glm.FunctionCall = FunctionCall
+    glm.FunctionResponse = FunctionResponse
+    glm.Content = Content
+
+    google.generativeai = genai
+    google.ai = ai
+    ai.generativelanguage = glm
+    sys.modules["google.generativeai"] = genai
+    sys.modules["google.ai"] = ai
+    sys.modules["google.ai.generativelanguage"] = glm
+
+    try:
+        import google.api_core.exceptions  # noqa: F401
+    except ImportError:
+        api_core = types.ModuleType("google.api_core")
+        api_core.__path__ = []
+        exceptions = types.ModuleType("google.api_core.exceptions")
+        exceptions.ResourceExhausted = ResourceExhausted
+        exceptions.DeadlineExceeded = DeadlineExceeded
+        api_core.exceptions = exceptions
+        google.api_core = api_core
+        sys.modules["google.api_core"] = api_core
+        sys.modules["google.api_core.exceptions"] = exceptions
@@ -0,0 +1,229 @@
+"""
+Offline throughput benchmark for recommendation-agent.
+
+Runs the real app under gunicorn with the fake Gemini SDK (fake_genai.py) and
+local stand-ins for catalog-reader and cartservice (stubs.py), drives /recommend
+with a closed-loop load generator, and reports throughput, latency percentiles
+and cache hit ratios for each gunicorn worker/thread configuration.
+
+Usage (from src/recommendation-agent):
+
+    python -m benchmark.run_benchmark --configs 1x1,1x8,4x8 --concurrency 32 --duration 30
+
+Queries are drawn from a Zipf distribution over --unique-queries phrasings, which
+gives a realistic mix of repeated (cacheable) and long-tail queries. Note that the
+recommendation cache is per worker process, so hit ratios drop as workers are added.
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmark import stubs
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROTOS_DIR = os.path.join(AGENT_DIR, "..", "..", "protos")
+
+QUERY_TEMPLATES = [
+    "{}", "show me {}", "I need a {}", "looking for {} please", "any good {} for a gift?",
+    "cheap {}", "what {} do you have", "recommend a {}",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def generate_protos(out_dir: str) -> str:
+    """Generates the demo.proto stubs into <out_dir>/genproto, as the Dockerfile does."""
+    genproto = os.path.join(out_dir, "genproto")
+    os.makedirs(genproto, exist_ok=True)
+    open(os.path.join(genproto, "__init__.py"), "w").close()
+    subprocess.check_call([
+        sys.executable, "-m", "grpc_tools.protoc", f"-I{PROTOS_DIR}",
+        f"--python_out={genproto}", f"--grpc_python_out={genproto}",
+        os.path.join(PROTOS_DIR, "demo.proto"),
+    ])
+    # The generated grpc module imports demo_pb2 as a top-level module
+    sys.path[:0] = [out_dir, genproto]
+    return os.pathsep.join([out_dir, genproto])
+
+
+def build_queries(products: list, unique_queries: int, seed: int) -> list:
+    rng = random.Random(seed)
+    keywords = sorted({p["name"].lower() for p in products} | {c for p in products for c in p["categories"]})
+    phrasings = [t.format(k) for k in keywords for t in QUERY_TEMPLATES]
+    rng.shuffle(phrasings)
+    return phrasings[:unique_queries]
+
+
+def zipf_weights(n: int, s: float) -> list:
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(url: str, queries: list, weights: list, args) -> dict:
+    latencies, outcomes = [], {}
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def client(client_id):
+        rng = random.Random(args.seed * 1000 + client_id)
+        session = requests.Session()
+        while time.time() < deadline:
+            query = rng.choices(queries, weights)[0]
+            variant = "B" if rng.random() < args.variant_b_ratio else "A"
+            start = time.perf_counter()
+            try:
+                response = session.post(url, json={"query": query, "variant": variant, "userId": f"user-{client_id}"},
+                                        timeout=args.request_timeout)
+                outcome = response.headers.get("X-Cache", "miss") if response.ok else f"http_{response.status_code}"
+            except requests.RequestException:
+                outcome = "error"
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if not outcome.startswith(("http_", "error")):
+                    latencies.append(elapsed_ms)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.concurrency)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    total = sum(outcomes.values())
+    served = sum(count for outcome, count in outcomes.items() if not outcome.startswith(("http_", "error")))
+    return {
+        "requests": total,
+        "throughput_rps": total / elapsed,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        # Entries past their soft TTL are still answered from the cache
+        "cache_hit_ratio": sum(outcomes.get(o, 0) for o in ("hit", "revalidate", "stale")) / served if served else 0.0,
+        "fallback_ratio": outcomes.get("fallback", 0) / served if served else 0.0,
+        "errors": total - served,
+    }
+
+
+def run_config(workers: int, threads: int, env: dict, queries: list, weights: list, args) -> dict:
+    port = free_port()
+    command = [
+        sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers), "--threads", str(threads), "--timeout", "120",
+        "--log-level", "warning", "benchmark.fake_app:app",
+    ]
+    with open(os.devnull, "w") as devnull:
+        server = subprocess.Popen(command, cwd=AGENT_DIR, env=env,
+                                  stdout=None if args.verbose else devnull,
+                                  stderr=None if args.verbose else devnull)
+        try:
+            wait_for_port(port)
+            result = run_load(f"http://127.0.0.1:{port}/recommend", queries, weights, args)
+        finally:
+            server.terminate()
+            server.wait()
+    return {"workers": workers, "threads": threads, **result}
+
+
+def print_report(results: list):
+    header = f"{'workers':>7} {'threads':>7} {'reqs':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'hit %':>6} {'fallbk %':>8} {'errors':>6}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['workers']:>7} {r['threads']:>7} {r['requests']:>7} {r['throughput_rps']:>8.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['cache_hit_ratio'] * 100:>6.1f} {r['fallback_ratio'] * 100:>8.1f} {r['errors']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", default="1x1,1x8,2x8,4x8",
+                        help="Comma-separated gunicorn <workers>x<threads> configurations")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent load generator clients")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load per configuration")
+    parser.add_argument("--unique-queries", type=int, default=200)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the query popularity")
+    parser.add_argument("--variant-b-ratio", type=float, default=0.5)
+    parser.add_argument("--llm-latency", default="lognormal:800:0.4", help="See FAKE_LLM_LATENCY in fake_genai.py")
+    parser.add_argument("--llm-script", help="JSON tool-call script, see FAKE_LLM_SCRIPT in fake_genai.py")
+    parser.add_argument("--catalog-latency-ms", type=float, default=5)
+    parser.add_argument("--cart-latency-ms", type=float, default=5)
+    parser.add_argument("--latency-budget", type=float, default=10, help="RECOMMEND_LATENCY_BUDGET_SECONDS for the app")
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the app's output")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="reco-bench-")
+    pythonpath = generate_protos(workdir)
+
+    products = stubs.load_products()
+    catalog_port, cart_port = free_port(), free_port()
+    stubs.start_catalog_reader(catalog_port, args.catalog_latency_ms, products)
+    cart_server = stubs.start_cartservice(cart_port, args.cart_latency_ms)
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(filter(None, [AGENT_DIR, pythonpath, os.environ.get("PYTHONPATH")])),
+        CATALOG_READER_URL=f"http://127.0.0.1:{catalog_port}",
+        CART_SERVICE_ADDR=f"127.0.0.1:{cart_port}",
+        GOOGLE_API_KEY="benchmark",
+        RECOMMEND_LATENCY_BUDGET_SECONDS=str(args.latency_budget),
+        FAKE_LLM_LATENCY=args.llm_latency,
+        FAKE_LLM_SEED=str(args.seed),
+    )
+    if args.llm_script:
+        env["FAKE_LLM_SCRIPT"] = os.path.abspath(args.llm_script)
+
+    queries = build_queries(products, args.unique_queries, args.seed)
+    weights = zipf_weights(len(queries), args.zipf)
+
+    results = []
+    for config in args.configs.split(","):
+        workers, threads = (int(n) for n in config.lower().split("x"))
+        print(f"Running {workers} worker(s) x {threads} thread(s) for {args.duration:.0f}s...", file=sys.stderr)
+        results.append(run_config(workers, threads, env, queries, weights, args))
+
+    cart_server.stop(0)
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
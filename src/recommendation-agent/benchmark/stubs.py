@@ -0,0 +1,96 @@
+"""
+Local stand-ins for catalog-reader and cartservice used by the benchmark harness.
+
+The catalog stand-in serves products.json from productcatalogservice over the same
+HTTP routes as catalog-reader. Its search matches a product when any word of the
+query appears in the product's name or description, so natural-language queries
+from the fake model still find something. The cart stand-in accepts every AddItem.
+"""
+
+import json
+import os
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import grpc
+
+PRODUCTS_JSON = os.path.join(
+    os.path.dirname(__file__), "..", "..", "productcatalogservice", "products.json"
+)
+
+
+def load_products(path=PRODUCTS_JSON) -> list:
+    with open(path) as f:
+        products = json.load(f)["products"]
+    # catalog-reader returns MessageToDict output, where int64 fields are strings
+    for product in products:
+        product["priceUsd"]["units"] = str(product["priceUsd"]["units"])
+    return products
+
+
+def search(products: list, query: str) -> list:
+    words = [w for w in query.lower().split() if len(w) > 2]
+    return [
+        p for p in products
+        if any(w in p["name"].lower() or w in p["description"].lower() for w in words)
+    ]
+
+
+def start_catalog_reader(port: int, latency_ms: float = 0, products=None) -> ThreadingHTTPServer:
+    products = products or load_products()
+    by_id = {p["id"]: p for p in products}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            if self.path == "/products":
+                return self._reply(200, products)
+            product = by_id.get(self.path.rsplit("/", 1)[-1])
+            if product is None:
+                return self._reply(404, {"error": "Product not found"})
+            self._reply(200, product)
+
+        def do_POST(self):
+            time.sleep(latency_ms / 1000)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            self._reply(200, search(products, body.get("query", "")))
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_cartservice(port: int, latency_ms: float = 0):
+    from genproto import demo_pb2, demo_pb2_grpc
+
+    class CartService(demo_pb2_grpc.CartServiceServicer):
+        def AddItem(self, request, context):
+            time.sleep(latency_ms / 1000)
+            return demo_pb2.Empty()
+
+        def GetCart(self, request, context):
+            return demo_pb2.Cart(user_id=request.user_id)
+
+        def EmptyCart(self, request, context):
+            return demo_pb2.Empty()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    demo_pb2_grpc.add_CartServiceServicer_to_server(CartService(), server)
+    server.add_insecure_port(f"127.0.0.1:{port}")
+    server.start()
+    return server
@@ -0,0 +1,111 @@
+"""
+Fair-share dispatch of model calls.
+
+Every call to Gemini takes a slot from a FairDispatcher first. The dispatcher
+caps the number of calls in flight, globally and per A/B variant, and when calls
+have to wait it serves users in start-time fair queuing order: each waiting call
+gets a virtual start tag of max(virtual time, that user's previous finish tag),
+and the smallest tag goes first. A user sending a burst of requests therefore
+only delays their own calls, and everyone else keeps getting their turn.
+
+A dispatcher only sees the calls of its own process: with several gunicorn
+workers or replicas, the caps add up across them.
+"""
+
+import itertools
+import threading
+import time
+
+# Per-user tags at or behind the virtual time carry no information and are pruned past this size
+MAX_TRACKED_USERS = 10000
+
+
+class DispatchTimeout(Exception):
+    """Raised when a call waited longer than its queue timeout for a slot."""
+
+
+class _Waiter:
+    __slots__ = ("start_tag", "seq", "user_id", "variant")
+
+    def __init__(self, start_tag, seq, user_id, variant):
+        self.start_tag = start_tag
+        self.seq = seq
+        self.user_id = user_id
+        self.variant = variant
+
+    def order(self):
+        return (self.start_tag, self.seq)
+
+
+class FairDispatcher:
+    def __init__(self, max_in_flight: int, variant_caps=None, user_weights=None):
+        self.max_in_flight = max_in_flight
+        self.variant_caps = dict(variant_caps or {})
+        self.user_weights = dict(user_weights or {})
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._variant_in_flight = {}
+        self._waiting = []
+        self._virtual_time = 0.0
+        self._user_finish = {}
+        self._seq = itertools.count()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def _has_capacity(self, variant) -> bool:
+        cap = self.variant_caps.get(variant)
+        return cap is None or self._variant_in_flight.get(variant, 0) < cap
+
+    def _next_waiter(self):
+        if self._in_flight >= self.max_in_flight:
+            return None
+        eligible = [w for w in self._waiting if self._has_capacity(w.variant)]
+        return min(eligible, key=_Waiter.order) if eligible else None
+
+    def acquire(self, user_id: str, variant: str, timeout=None) -> float:
+        """Blocks until the call may run and returns how long it waited, in seconds."""
+        start = time.monotonic()
+        with self._cond:
+            start_tag = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+            self._user_finish[user_id] = start_tag + 1.0 / self.user_weights.get(user_id, 1.0)
+            waiter = _Waiter(start_tag, next(self._seq), user_id, variant)
+            self._waiting.append(waiter)
+
+            while self._next_waiter() is not waiter:
+                remaining = None if timeout is None else timeout - (time.monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    self._waiting.remove(waiter)
+                    self._cond.notify_all()
+                    raise DispatchTimeout(f"No model slot for user {user_id} within {timeout:.1f}s")
+                self._cond.wait(remaining)
+
+            self._waiting.remove(waiter)
+            self._in_flight += 1
+            self._variant_in_flight[variant] = self._variant_in_flight.get(variant, 0) + 1
+            self._virtual_time = max(self._virtual_time, waiter.start_tag)
+            # Another waiter of a different variant may be eligible as well
+            self._cond.notify_all()
+        return time.monotonic() - start
+
+    def release(self, variant: str):
+        with self._cond:
+            self._in_flight -= 1
+            self._variant_in_flight[variant] -= 1
+            if len(self._user_finish) > MAX_TRACKED_USERS:
+                self._user_finish = {u: f for u, f in self._user_finish.items() if f > self._virtual_time}
+            self._cond.notify_all()
+
+
+def parse_assignments(spec: str, value_type=int) -> dict:
+    """Parses "A=12,B=4" into {"A": 12, "B": 4}."""
+    assignments = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        assignments[name.strip()] = value_type(value)
+    return assignments
@@ -0,0 +1,245 @@
+"""
+A/B experiment analytics: streaming quantile sketches per variant.
+
+For every /recommend request the agent records, per variant, the end-to-end
+latency and the response size, and for every model conversation the number of
+tool calls. Each of these goes into a DDSketch: a histogram with logarithmically
+sized buckets that answers any quantile within a fixed relative error (1% by
+default) in bounded memory, and that merges exactly with other sketches of the
+same accuracy by adding up bucket counts.
+
+That makes the stats mergeable at every level:
+
+- gunicorn workers write their sketches to a shared directory, and
+  /experiments/stats on any worker merges all of them into the pod's view;
+- /experiments/stats?sketches=1 includes the serialized sketches, and this module
+  merges the responses of several pods into a fleet-level view:
+
+    python experiments.py http://pod-a:8080 http://pod-b:8080
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+
+METRICS = ("latency_ms", "tool_calls", "response_bytes")
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Beyond this many buckets the lowest ones are folded together, which only
+# costs accuracy for the smallest values
+MAX_BINS = 2048
+
+
+class DDSketch:
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        # Midpoint of the bucket (gamma^(key-1), gamma^key], within the relative accuracy of both ends
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value: float):
+        if value < 0:
+            raise ValueError(f"DDSketch only tracks non-negative values, got {value}")
+        if value == 0:
+            self.zero_count += 1
+        else:
+            key = self._key(value)
+            self.bins[key] = self.bins.get(key, 0) + 1
+            if len(self.bins) > MAX_BINS:
+                self._collapse()
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        lowest = keys[len(keys) - MAX_BINS]
+        for key in keys[:len(keys) - MAX_BINS]:
+            self.bins[lowest] += self.bins.pop(key)
+
+    def merge(self, other: "DDSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "bins": {str(key): count for key, count in self.bins.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        sketch = cls(data["relative_accuracy"])
+        sketch.bins = {int(key): count for key, count in data["bins"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min, sketch.max = data["min"], data["max"]
+        return sketch
+
+
+def merge_sketch_sets(sketch_sets) -> dict:
+    """Merges several {variant: {metric: DDSketch}} into a new one."""
+    merged = {}
+    for sketches in sketch_sets:
+        for variant, metrics in sketches.items():
+            for metric, sketch in metrics.items():
+                target = merged.setdefault(variant, {}).get(metric)
+                if target is None:
+                    target = merged[variant][metric] = DDSketch(sketch.relative_accuracy)
+                target.merge(sketch)
+    return merged
+
+
+def serialize_sketches(sketches: dict) -> dict:
+    return {variant: {metric: s.to_dict() for metric, s in metrics.items()} for variant, metrics in sketches.items()}
+
+
+def deserialize_sketches(data: dict) -> dict:
+    return {variant: {metric: DDSketch.from_dict(s) for metric, s in metrics.items()} for variant, metrics in data.items()}
+
+
+def summarize(sketches: dict, quantiles=QUANTILES) -> dict:
+    """Count, mean, min, max and quantiles of every sketch, by variant and metric."""
+    return {
+        variant: {
+            metric: {
+                "count": sketch.count,
+                "mean": sketch.sum / sketch.count if sketch.count else None,
+                "min": sketch.min if sketch.count else None,
+                "max": sketch.max if sketch.count else None,
+                **{f"p{round(q * 100, 1):g}": sketch.quantile(q) for q in quantiles},
+            }
+            for metric, sketch in sorted(metrics.items())
+        }
+        for variant, metrics in sorted(sketches.items())
+    }
+
+
+class ExperimentStats:
+    """
+    The sketches of one worker process. With a state directory, flush() writes them
+    to a file per process there and merged() combines them with the other workers'.
+    Given the known variants, values recorded for any other variant are dropped, so
+    a client making up variant names can't grow the sketches, the files or the stats.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY, state_dir=None, variants=None):
+        self.relative_accuracy = relative_accuracy
+        self.state_dir = state_dir
+        self.variants = frozenset(variants) if variants is not None else None
+        self._sketches = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _state_file(self, pid=None) -> str:
+        return os.path.join(self.state_dir, f"experiments_{pid or os.getpid()}.json")
+
+    def record(self, variant: str, metric: str, value: float):
+        if self.variants is not None and variant not in self.variants:
+            return
+        with self._lock:
+            sketch = self._sketches.setdefault(variant, {}).get(metric)
+            if sketch is None:
+                sketch = self._sketches[variant][metric] = DDSketch(self.relative_accuracy)
+            sketch.add(value)
+            self._dirty = True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return merge_sketch_sets([self._sketches])
+
+    def flush(self):
+        if not self.state_dir:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = serialize_sketches(self._sketches)
+            self._dirty = False
+        path = self._state_file()
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def merged(self) -> dict:
+        """This worker's sketches merged with those the other workers last flushed."""
+        sketch_sets = [self.snapshot()]
+        if self.state_dir:
+            own = os.path.basename(self._state_file())
+            for name in os.listdir(self.state_dir):
+                if not name.startswith("experiments_") or not name.endswith(".json") or name == own:
+                    continue
+                try:
+                    with open(os.path.join(self.state_dir, name)) as f:
+                        sketch_sets.append(deserialize_sketches(json.load(f)))
+                except (OSError, ValueError, KeyError):
+                    # Being replaced right now, or from an incompatible version
+                    continue
+        return merge_sketch_sets(sketch_sets)
+
+
+def main():
+    import requests
+
+    parser = argparse.ArgumentParser(description="Merge /experiments/stats of several recommendation-agent pods.")
+    parser.add_argument("urls", nargs="+", help="Base URLs of the pods, e.g. http://10.0.0.12:8080")
+    args = parser.parse_args()
+
+    sketch_sets = []
+    for url in args.urls:
+        response = requests.get(f"{url.rstrip('/')}/experiments/stats", params={"sketches": "1"}, timeout=10)
+        response.raise_for_status()
+        sketch_sets.append(deserialize_sketches(response.json()["sketches"]))
+    print(json.dumps(summarize(merge_sketch_sets(sketch_sets)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+# gunicorn loads ./gunicorn.conf.py automatically.
+# These hooks keep the multi-process Prometheus metrics directory consistent (see telemetry.py).
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+# A request mostly waits on the model, so each worker serves many of them on threads.
+# With the default sync worker a process handles one request at a time, and the
+# dispatcher's caps and the in-flight dedup in app.py never come into play.
+# Command line flags (as the benchmark passes them) take precedence.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+
+
+def on_starting(server):
+    # Samples left over from a previous run would be aggregated with the new ones
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(worker.pid)
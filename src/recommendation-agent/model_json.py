@@ -0,0 +1,152 @@
+"""
+Helpers for parsing the JSON documents produced by the generative model.
+
+The model is asked to answer with a single JSON object such as
+{"suggestions": [...], "compare": "..."} or {"message": "..."}. When the
+response is streamed we don't want to wait for the closing brace of the whole
+document before showing anything, so SuggestionStreamParser scans the text as
+it arrives and hands back each entry of the top-level "suggestions" array as
+soon as that entry's object is complete.
+"""
+
+import json
+
+SUGGESTIONS_KEY = "suggestions"
+
+
+class SuggestionStreamParser:
+    """
+    Incremental scanner for the model's JSON output.
+
+    Feed it text chunks with feed(); every call returns the list of
+    suggestion objects that became complete with that chunk. The scanner only
+    tracks string/escape state and the container nesting, so it tolerates
+    markdown fences or other noise around the JSON object. The complete raw
+    text is kept in `text` so the caller can parse the full document at the end.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        # Stack of open containers: '{' or '['
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        # Start offset of the string being scanned and the last complete
+        # string seen at the top level of the root object (i.e. the last key).
+        self._string_start = None
+        self._last_root_string = None
+        self._expect_value_for = None
+        # Depth of the "suggestions" array, and start of the item being captured.
+        self._suggestions_depth = None
+        self._item_start = None
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        completed = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._stack[0] == "{":
+                        self._last_root_string = text[self._string_start + 1:i]
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ":":
+                if len(self._stack) == 1 and self._stack[0] == "{":
+                    self._expect_value_for = self._last_root_string
+            elif ch in "{[":
+                if (ch == "[" and len(self._stack) == 1
+                        and self._expect_value_for == SUGGESTIONS_KEY):
+                    self._suggestions_depth = len(self._stack) + 1
+                self._stack.append(ch)
+                if (ch == "{" and self._suggestions_depth is not None
+                        and len(self._stack) == self._suggestions_depth + 1):
+                    self._item_start = i
+            elif ch in "}]":
+                if not self._stack:
+                    continue
+                depth = len(self._stack)
+                self._stack.pop()
+                if (ch == "}" and self._item_start is not None
+                        and depth == self._suggestions_depth + 1):
+                    try:
+                        completed.append(json.loads(text[self._item_start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._item_start = None
+                elif ch == "]" and depth == self._suggestions_depth:
+                    self._suggestions_depth = None
+            elif ch == "," and len(self._stack) == 1:
+                self._expect_value_for = None
+        self._pos = len(text)
+        return completed
+
+
+class ModelResponseError(ValueError):
+    """Raised when the model's output is not a JSON object of a known shape."""
+
+
+_decoder = json.JSONDecoder()
+
+
+def extract_json_object(response_text: str) -> dict:
+    """
+    Extracts the first JSON object from a model response in a single pass.
+    The model is in JSON mode, but as a fallback this tolerates markdown fences
+    or prose around the object: decoding starts at the first '{' and stops at
+    the end of that object, ignoring whatever follows.
+    """
+    json_start = response_text.find('{')
+    if json_start == -1:
+        raise ModelResponseError("No JSON object found in response")
+    try:
+        obj, _ = _decoder.raw_decode(response_text, json_start)
+    except json.JSONDecodeError as e:
+        raise ModelResponseError(f"Invalid JSON in response: {e}") from e
+    return obj
+
+
+def validate_model_response(obj) -> dict:
+    """
+    Checks that a decoded response has one of the shapes the prompts ask for:
+    {"suggestions": [{..., "why": "..."}], "compare": ...} or {"message": "..."}.
+    """
+    if not isinstance(obj, dict):
+        raise ModelResponseError("Response is not a JSON object")
+    if SUGGESTIONS_KEY not in obj and "message" not in obj:
+        raise ModelResponseError("Response has neither 'suggestions' nor 'message'")
+
+    if SUGGESTIONS_KEY in obj:
+        suggestions = obj[SUGGESTIONS_KEY]
+        if not isinstance(suggestions, list):
+            raise ModelResponseError("'suggestions' is not a list")
+        for suggestion in suggestions:
+            if not isinstance(suggestion, dict):
+                raise ModelResponseError("A suggestion is not a JSON object")
+            if not isinstance(suggestion.get("why"), str):
+                raise ModelResponseError("A suggestion is missing its 'why' text")
+        if "compare" in obj and not isinstance(obj["compare"], (str, list, dict)):
+            raise ModelResponseError("'compare' has an unexpected type")
+    if "message" in obj and not isinstance(obj["message"], str):
+        raise ModelResponseError("'message' is not a string")
+    return obj
+
+
+def parse_model_response(response_text: str) -> dict:
+    """Extracts and validates the JSON object in a model response."""
+    return validate_model_response(extract_json_object(response_text))
+
+
+def serialize_response(obj: dict) -> bytes:
+    """Pre-serializes a validated response so cache hits can be written out as-is."""
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,76 @@
+"""
+Complexity-based routing of queries between a fast and a large model tier.
+
+Most queries are simple lookups ("show me mugs") that a small, fast model answers
+just as well as the large one. The router scores each query on a few cheap
+signals and only sends the ones that look demanding to the large model:
+
+- length: long queries tend to carry several requirements,
+- comparison words: "compare", "vs", "better", "difference", ...,
+- constraints: prices, numbers and words like "under", "without", "for",
+- conversation state: follow-ups need the model to keep track of earlier answers.
+
+A score at or above the threshold goes to the large tier. Per-variant overrides
+pin a variant to one tier, so the routing itself can be A/B tested.
+"""
+
+import re
+
+FAST_TIER = "fast"
+LARGE_TIER = "large"
+AUTO = "auto"
+
+COMPARISON_WORDS = {
+    "compare", "comparison", "vs", "versus", "better", "best", "difference", "differences",
+    "between", "which", "alternative", "alternatives", "pros", "cons", "tradeoff", "tradeoffs",
+}
+CONSTRAINT_WORDS = {
+    "under", "below", "over", "above", "less", "more", "than", "cheaper", "cheapest", "budget",
+    "without", "except", "but", "not", "only", "must", "for", "with", "and",
+}
+NUMBER_PATTERN = re.compile(r"[$€£]?\d+(?:[.,]\d+)?")
+
+LONG_QUERY_WORDS = 10
+VERY_LONG_QUERY_WORDS = 20
+MAX_CONSTRAINT_POINTS = 3
+
+
+def tokenize(query: str) -> list:
+    return "".join(c if c.isalnum() or c in "$€£.," else " " for c in query.lower()).split()
+
+
+def score_complexity(query: str, history_turns: int = 0) -> int:
+    """Scores how demanding a query is; 0 is a plain lookup."""
+    words = [w.strip(".,") for w in tokenize(query)]
+    score = 0
+    if len(words) >= LONG_QUERY_WORDS:
+        score += 1
+    if len(words) >= VERY_LONG_QUERY_WORDS:
+        score += 1
+    if any(word in COMPARISON_WORDS for word in words):
+        score += 2
+    constraints = sum(word in CONSTRAINT_WORDS for word in words) + len(NUMBER_PATTERN.findall(query))
+    score += min(constraints, MAX_CONSTRAINT_POINTS)
+    if history_turns:
+        score += 1 if history_turns < 3 else 2
+    return score
+
+
+class ModelRouter:
+    def __init__(self, fast_model: str, large_model: str, threshold: int, variant_overrides=None):
+        self.models = {FAST_TIER: fast_model, LARGE_TIER: large_model}
+        self.threshold = threshold
+        self.variant_overrides = {}
+        for variant, tier in (variant_overrides or {}).items():
+            tier = tier.strip().lower()
+            if tier not in (FAST_TIER, LARGE_TIER, AUTO):
+                raise ValueError(f"Unknown model tier '{tier}' for variant {variant}; use fast, large or auto")
+            self.variant_overrides[variant.upper()] = tier
+
+    def route(self, query: str, variant: str, history_turns: int = 0):
+        """Returns (tier, model name, complexity score) for a query."""
+        score = score_complexity(query, history_turns)
+        tier = self.variant_overrides.get(variant, AUTO)
+        if tier == AUTO:
+            tier = LARGE_TIER if score >= self.threshold else FAST_TIER
+        return tier, self.models[tier], score
@@ -0,0 +1,36 @@
+"""
+Queries as /recommend receives them: which ones are action intents, and reading
+them back from a query log.
+
+Action intents (adding to the cart or watchlist) change state, so the cache key
+normalization leaves them alone, the cache and in-flight dedup are bypassed for
+them and the warm-up never replays them. The query log is NDJSON with one
+/recommend request body per line, for example {"query": "show me mugs", "variant": "B"}.
+"""
+
+import json
+
+ACTION_WORDS = ("add", "cart", "watchlist", "remove", "buy", "order")
+
+
+def is_action_intent(query: str) -> bool:
+    words = "".join(c if c.isalnum() else " " for c in query.lower()).split()
+    return any(word in ACTION_WORDS for word in words)
+
+
+def load_query_log(path: str, query_field: str = "query") -> list:
+    """Returns (query, variant) pairs from an NDJSON log; lines without a query are skipped."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            query = record.get(query_field) if isinstance(record, dict) else None
+            if isinstance(query, str) and query.strip():
+                entries.append((query, str(record.get("variant", "A")).upper()))
+    return entries
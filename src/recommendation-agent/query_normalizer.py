@@ -0,0 +1,139 @@
+"""
+Canonical form of queries for recommendation cache keys.
+
+The cache used to be keyed by the raw query, so "Show me mugs", "show me mugs!"
+and "mugs please" were three entries and three model calls. Before the cache
+lookup, queries now go through a pipeline of normalization steps:
+
+- unicode:      NFKC normalization (full-width characters, ligatures, ...)
+- casefold:     case-insensitive comparison, including non-ASCII letters
+- numbers:      "$1,000.00" -> "1000", "49.50" -> "49.5"
+- punctuation:  punctuation becomes whitespace, runs of whitespace collapse
+- stop_phrases: filler such as "please", "can you", "show me" is dropped
+- sort_tokens:  word order is ignored, so bag-of-words-equal queries share a key
+
+The normalized form is only used as the cache key; the model still gets the query
+as the user wrote it. Action intents (adding to the cart or watchlist) are never
+normalized, so two requests only share an entry if they are exactly the same.
+
+Run it against a query log to see what the pipeline gains:
+
+    python query_normalizer.py --log queries.jsonl --cache-size 100
+"""
+
+import argparse
+import re
+import unicodedata
+from collections import OrderedDict
+
+from queries import is_action_intent, load_query_log
+
+STEPS = ("unicode", "casefold", "numbers", "punctuation", "stop_phrases", "sort_tokens")
+DEFAULT_STOP_PHRASES = (
+    "please", "pls", "thanks", "thank you", "can you", "could you", "would you", "can i", "could i",
+    "show me", "find me", "find", "give me", "get me", "i want", "i need", "i would like", "i'd like",
+    "i am looking for", "i'm looking for", "looking for", "do you have", "a", "an", "the", "some", "any",
+)
+
+NUMBER_PATTERN = re.compile(r"[$€£]?(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d+))?")
+# Anything but letters, digits and whitespace; dots survive only inside numbers
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s.]|_|(?<!\d)\.|\.(?!\d)")
+
+
+def normalize_number(match) -> str:
+    integer, fraction = match.group(1).replace(",", ""), (match.group(2) or "").rstrip("0")
+    return f"{int(integer)}.{fraction}" if fraction else str(int(integer))
+
+
+class QueryNormalizer:
+    def __init__(self, steps=STEPS, stop_phrases=DEFAULT_STOP_PHRASES):
+        unknown = set(steps) - set(STEPS)
+        if unknown:
+            raise ValueError(f"Unknown normalization steps: {', '.join(sorted(unknown))}")
+        self.steps = tuple(step for step in STEPS if step in steps)
+        # Stop phrases are matched on whole tokens, longest first
+        self.stop_phrases = sorted(
+            {tuple(phrase.casefold().replace("'", " ").split()) for phrase in stop_phrases if phrase.strip()},
+            key=len, reverse=True)
+
+    def normalize(self, query: str) -> str:
+        if not self.steps or is_action_intent(query):
+            return query
+        if "unicode" in self.steps:
+            query = unicodedata.normalize("NFKC", query)
+        if "casefold" in self.steps:
+            query = query.casefold()
+        if "numbers" in self.steps:
+            query = NUMBER_PATTERN.sub(normalize_number, query)
+        if "punctuation" in self.steps:
+            query = PUNCTUATION_PATTERN.sub(" ", query)
+        tokens = query.split()
+        if "stop_phrases" in self.steps:
+            tokens = self.remove_stop_phrases(tokens) or tokens
+        if "sort_tokens" in self.steps:
+            tokens = sorted(tokens)
+        return " ".join(tokens)
+
+    def remove_stop_phrases(self, tokens: list) -> list:
+        kept, i = [], 0
+        while i < len(tokens):
+            for phrase in self.stop_phrases:
+                if tuple(tokens[i:i + len(phrase)]) == phrase:
+                    i += len(phrase)
+                    break
+            else:
+                kept.append(tokens[i])
+                i += 1
+        return kept
+
+
+def parse_steps(spec: str) -> tuple:
+    """Parses a comma-separated step list; "all" is every step and "none" (or "") disables normalization."""
+    spec = spec.strip().lower()
+    if spec == "all":
+        return STEPS
+    if spec in ("", "none"):
+        return ()
+    return tuple(step.strip() for step in spec.split(",") if step.strip())
+
+
+def simulate_hit_rate(entries: list, key_func, cache_size: int = 0) -> float:
+    """Replays (query, variant) pairs through an LRU cache keyed by key_func (0 = unbounded)."""
+    cache = OrderedDict()
+    hits = 0
+    for query, variant in entries:
+        key = (variant, key_func(query))
+        if key in cache:
+            hits += 1
+            cache.move_to_end(key)
+            continue
+        cache[key] = True
+        if cache_size and len(cache) > cache_size:
+            cache.popitem(last=False)
+    return hits / len(entries) if entries else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the cache hit rate gained by query normalization on a query log.")
+    parser.add_argument("--log", required=True, help="NDJSON query log, as for the cache warm-up")
+    parser.add_argument("--query-field", default="query")
+    parser.add_argument("--steps", default="all", help="Comma-separated steps to evaluate (default: all)")
+    parser.add_argument("--cache-size", type=int, default=0, help="LRU cache size to simulate (0 = unbounded)")
+    args = parser.parse_args()
+
+    entries = load_query_log(args.log, args.query_field)
+    steps = parse_steps(args.steps)
+    raw = simulate_hit_rate(entries, lambda query: query, args.cache_size)
+    print(f"{len(entries)} queries, cache size {args.cache_size or 'unbounded'}")
+    print(f"  {'raw query':<28} {raw * 100:6.2f}% hits")
+    # Each step on its own, then the whole pipeline
+    for step in steps:
+        rate = simulate_hit_rate(entries, QueryNormalizer((step,)).normalize, args.cache_size)
+        print(f"  {step + ' only':<28} {rate * 100:6.2f}% hits ({(rate - raw) * 100:+.2f})")
+    rate = simulate_hit_rate(entries, QueryNormalizer(steps).normalize, args.cache_size)
+    print(f"  {'all of: ' + ','.join(steps)}")
+    print(f"  {'':<28} {rate * 100:6.2f}% hits ({(rate - raw) * 100:+.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Bounded per-user store of chat history for multi-turn conversations.
+
+Without history every request starts a fresh chat, so a follow-up such as
+"add the second one to my cart" makes the model search all over again. The store
+keeps, per userId, the recent exchanges (user query and the model's final answer,
+without the intermediate tool traffic) and hands them back as chat history.
+
+Memory is bounded three ways: sessions idle for longer than the idle timeout are
+dropped, the least recently used sessions are evicted beyond the session limit or
+the memory cap, and each session's history is compacted to a token budget by
+folding the oldest exchanges into a short summary.
+"""
+
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from tool_output import estimate_tokens
+
+# Phrases that refer back to an earlier turn ("the second one", "cheaper than that").
+# Single words like "one" or "this" also appear in ordinary first questions
+# ("which one is best for hiking"), so they only count inside such phrases.
+FOLLOW_UP_PATTERN = re.compile(
+    r"\bthe (first|second|third|fourth|fifth|last|previous|other|same|above)"
+    r"( (one|ones|item|items|option|options|product|products|suggestion|suggestions)\b| to\b|$)"
+    r"|\b(this|that|these|those|another|other) ones?\b"
+    r"|\b(than|like|of|about|to|with) (that|this|these|those|it|them)$"
+    r"|\b(instead|you suggested|you showed|you mentioned)\b"
+)
+
+# Rough per-entry bookkeeping overhead used in the memory estimate
+SESSION_OVERHEAD_BYTES = 512
+EXCHANGE_OVERHEAD_BYTES = 128
+
+
+def is_follow_up(query: str) -> bool:
+    words = "".join(c if c.isalnum() else " " for c in query.lower()).split()
+    return FOLLOW_UP_PATTERN.search(" ".join(words)) is not None
+
+
+def summarize_exchange(user_query: str, model_text: str) -> str:
+    """One-line digest of an exchange: what was asked and which products came up."""
+    products = []
+    try:
+        answer = json.loads(model_text)
+        for suggestion in answer.get("suggestions", []):
+            name, product_id = suggestion.get("name"), suggestion.get("id") or suggestion.get("product_id")
+            products.append(f"{name} ({product_id})" if name and product_id else str(name or product_id))
+        if not products and answer.get("message"):
+            products.append(answer["message"][:80])
+    except (ValueError, AttributeError):
+        pass
+    return f"asked '{user_query}'" + (f" -> {', '.join(products)}" if products else "")
+
+
+class Session:
+    def __init__(self):
+        self.summary = []
+        self.exchanges = []
+        self.last_used = time.monotonic()
+
+    def tokens(self) -> int:
+        return sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.exchanges) + \
+            sum(estimate_tokens(s) for s in self.summary)
+
+    def size_bytes(self) -> int:
+        return SESSION_OVERHEAD_BYTES + \
+            sum(len(q) + len(a) + EXCHANGE_OVERHEAD_BYTES for q, a in self.exchanges) + \
+            sum(len(s) for s in self.summary)
+
+
+class ChatSessionStore:
+    def __init__(self, max_sessions: int, idle_timeout: float, token_budget: int,
+                 memory_cap_bytes: int, max_summary_items: int = 10):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.token_budget = token_budget
+        self.memory_cap_bytes = memory_cap_bytes
+        self.max_summary_items = max_summary_items
+        self._sessions = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def expire(self):
+        """Drops idle sessions now rather than on the next access."""
+        with self._lock:
+            self._expire()
+
+    def history(self, user_id: str) -> list:
+        """Returns the user's compacted history in the SDK's chat history format."""
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(user_id)
+            if session is None:
+                return []
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            history = []
+            if session.summary:
+                history.append({"role": "user", "parts": ["Summary of our earlier conversation: " + "; ".join(session.summary)]})
+                history.append({"role": "model", "parts": ['{"message": "Noted."}']})
+            for user_query, model_text in session.exchanges:
+                history.append({"role": "user", "parts": [user_query]})
+                history.append({"role": "model", "parts": [model_text]})
+            return history
+
+    def record_exchange(self, user_id: str, user_query: str, model_text: str):
+        with self._lock:
+            session = self._sessions.pop(user_id, None)
+            if session is None:
+                session = Session()
+            else:
+                self._memory_bytes -= session.size_bytes()
+            session.exchanges.append((user_query, model_text))
+            session.last_used = time.monotonic()
+            self._compact(session)
+            self._sessions[user_id] = session
+            self._memory_bytes += session.size_bytes()
+            self._expire()
+            self._evict()
+
+    def _compact(self, session: Session):
+        # Fold the oldest exchanges into the summary until the history fits its token budget,
+        # always keeping the latest exchange verbatim
+        while len(session.exchanges) > 1 and session.tokens() > self.token_budget:
+            session.summary.append(summarize_exchange(*session.exchanges.pop(0)))
+            del session.summary[:-self.max_summary_items]
+
+    def _drop_oldest(self):
+        _, session = self._sessions.popitem(last=False)
+        self._memory_bytes -= session.size_bytes()
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._sessions and next(iter(self._sessions.values())).last_used < cutoff:
+            self._drop_oldest()
+
+    def _evict(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions
+                                  or self._memory_bytes > self.memory_cap_bytes):
+            self._drop_oldest()
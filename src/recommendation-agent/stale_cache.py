@@ -0,0 +1,67 @@
+"""
+LRU cache with a soft and a hard TTL per entry.
+
+Entries younger than the soft TTL are fresh. Between the soft and the hard TTL
+they are stale but still usable: the caller serves them and refreshes them in the
+background (stale-while-revalidate), and if that refresh fails the entry is marked
+so the caller can flag it as stale when serving it (stale-if-error). Entries older
+than the hard TTL are dropped.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ("value", "stored_at", "refresh_failed")
+
+    def __init__(self, value):
+        self.value = value
+        self.stored_at = time.monotonic()
+        self.refresh_failed = False
+
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+
+class StaleCache:
+    def __init__(self, maxsize: int, soft_ttl: float, hard_ttl: float):
+        if hard_ttl < soft_ttl:
+            raise ValueError(f"Hard TTL ({hard_ttl}s) must not be shorter than the soft TTL ({soft_ttl}s)")
+        self.maxsize = maxsize
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the CacheEntry for key, or None if there is none younger than the hard TTL."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.age() >= self.hard_ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return entry.age() < self.soft_ttl
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = CacheEntry(value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def mark_refresh_failed(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refresh_failed = True
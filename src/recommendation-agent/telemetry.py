@@ -0,0 +1,123 @@
+"""
+Prometheus metrics for recommendation-agent, served from /metrics.
+
+gunicorn runs several worker processes, each with its own in-memory metrics.
+When PROMETHEUS_MULTIPROC_DIR is set (the Dockerfile does this), every worker
+writes its samples to files in that directory and /metrics aggregates all of
+them, so a scrape of any worker returns the numbers for the whole pod.
+gunicorn.conf.py clears the directory on start and cleans up after dead workers.
+"""
+
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+
+# Buckets in seconds, from sub-millisecond cache lookups up to slow multi-turn model calls
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+SLOW_BUCKETS = (.05, .1, .25, .5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+TOOL_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+REQUEST_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+# --- Stage latencies ---
+request_latency = Histogram(
+    "recommend_request_seconds", "End-to-end latency of /recommend",
+    ["variant", "outcome"], buckets=REQUEST_BUCKETS)
+cache_lookup_latency = Histogram(
+    "recommend_cache_lookup_seconds", "Latency of the recommendation cache lookup",
+    buckets=FAST_BUCKETS)
+llm_latency = Histogram(
+    "llm_request_seconds", "Latency of the whole model conversation for one recommendation, including tool calls",
+    ["variant"], buckets=SLOW_BUCKETS)
+llm_tier_latency = Histogram(
+    "llm_tier_request_seconds", "Latency of a whole model conversation by routed model tier",
+    ["tier"], buckets=SLOW_BUCKETS)
+llm_turn_latency = Histogram(
+    "llm_turn_seconds", "Latency of a single model turn in the function calling loop",
+    ["turn"], buckets=SLOW_BUCKETS)
+llm_first_chunk_latency = Histogram(
+    "llm_time_to_first_chunk_seconds", "Time until the first streamed chunk of model output is available",
+    buckets=SLOW_BUCKETS)
+tool_call_latency = Histogram(
+    "tool_call_seconds", "Latency of a single tool call",
+    ["tool"], buckets=TOOL_BUCKETS)
+tool_turn_latency = Histogram(
+    "tool_turn_seconds", "Wall time of running all function calls of one model turn",
+    buckets=TOOL_BUCKETS)
+json_parse_latency = Histogram(
+    "model_json_parse_seconds", "Time spent extracting and validating the model's JSON",
+    buckets=FAST_BUCKETS)
+llm_queue_wait = Histogram(
+    "llm_queue_wait_seconds", "Time a model call waited in the dispatch queue for a slot",
+    ["variant"], buckets=REQUEST_BUCKETS)
+llm_request_tokens = Histogram(
+    "llm_request_tokens", "Input plus output tokens of one model conversation",
+    ["variant"], buckets=TOKEN_BUCKETS)
+tool_output_tokens = Histogram(
+    "tool_output_tokens", "Estimated tokens of a tool result before and after projection",
+    ["tool", "stage"], buckets=TOKEN_BUCKETS)
+
+# --- Counters ---
+cache_hits = Counter("recommend_cache_hits_total", "Recommendations served from the cache", ["variant"])
+cache_misses = Counter("recommend_cache_misses_total", "Recommendations that needed a model call", ["variant"])
+stale_served = Counter(
+    "recommend_stale_served_total",
+    "Cache hits served past the soft TTL, while revalidating or because the refresh failed",
+    ["variant", "reason"])
+tool_call_errors = Counter(
+    "tool_call_errors_total", "Tool calls that raised instead of returning a result, e.g. for bad arguments",
+    ["tool"])
+tool_cache_hits = Counter("tool_cache_hits_total", "Tool calls answered from the tool-result cache", ["tool"])
+tool_cache_misses = Counter("tool_cache_misses_total", "Tool calls that had to go to the backing service", ["tool"])
+tool_prefetches = Counter(
+    "tool_prefetches_total",
+    "Speculative product detail prefetches by outcome: started, used, failed, or unused within the tool cache TTL",
+    ["outcome"])
+fallbacks = Counter(
+    "recommend_fallbacks_total",
+    "Requests answered with local fallback recommendations because the latency budget ran out", ["variant"])
+llm_queue_timeouts = Counter(
+    "llm_queue_timeouts_total", "Model calls that gave up waiting in the dispatch queue", ["variant"])
+llm_quota_retries = Counter(
+    "llm_quota_retries_total", "Model calls requeued after the API reported exhausted quota", ["variant"])
+llm_routed = Counter("llm_routed_total", "Model conversations by variant and routed model tier", ["variant", "tier"])
+llm_tier_errors = Counter(
+    "llm_tier_errors_total", "Model conversations that failed, including invalid output, by model tier", ["tier"])
+llm_tokens = Counter(
+    "llm_tokens_total", "Model tokens by kind: input, output, and tokens of turns after tool calls (tool_turn)",
+    ["variant", "model", "kind"])
+llm_cost = Counter("llm_cost_usd_total", "Estimated model cost in USD", ["variant", "model"])
+token_budget_exhausted = Counter(
+    "llm_token_budget_exhausted_total", "Requests turned away from the model because the daily token budget ran out",
+    ["variant"])
+parse_failures = Counter(
+    "model_parse_failures_total", "Model responses that were not valid JSON of a known shape", ["variant"])
+
+# --- Gauges ---
+# In multi-process mode, "livesum" adds up the values of the workers that are still alive
+chat_sessions = Gauge("chat_sessions", "Chat sessions held in memory", multiprocess_mode="livesum")
+chat_session_memory = Gauge(
+    "chat_session_memory_bytes", "Estimated memory used by chat sessions", multiprocess_mode="livesum")
+llm_tokens_window = Gauge(
+    "llm_tokens_window", "Model tokens over a rolling window (1m, 5m, 1h)",
+    ["variant", "model", "kind", "window"], multiprocess_mode="livesum")
+# Workers share one budget, so they all report about the same number; the lowest is the latest
+llm_token_budget_remaining = Gauge(
+    "llm_token_budget_remaining", "Tokens left in today's budget shared by the worker processes",
+    multiprocess_mode="livemin")
+llm_queue_depth = Gauge(
+    "llm_queue_depth", "Model calls waiting in the dispatch queue", ["variant"], multiprocess_mode="livesum")
+llm_in_flight = Gauge(
+    "llm_in_flight", "Model calls currently running", ["variant"], multiprocess_mode="livesum")
+
+
+def render_metrics():
+    """Returns (body, content type) for the /metrics endpoint."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,137 @@
+"""
+Token usage and cost accounting for model calls.
+
+Every model turn reports its usage metadata (prompt and candidate tokens). Per
+recommendation these add up to three numbers:
+
+- input:     prompt tokens over all turns, each turn resending the conversation so far,
+- output:    tokens the model generated over all turns,
+- tool_turn: input and output tokens of the turns after the first, i.e. what the
+             function calling round trips cost on top of a plain answer.
+
+TokenUsage keeps per-minute totals for each (variant, model, kind) so it can report
+rolling windows (last minute, 5 minutes, hour), prices the tokens per model, and
+enforces an optional daily token budget that resets at midnight UTC.
+
+The rolling windows are per process. The tokens used today are kept in a file in
+a state directory instead, under an exclusive lock, so every process using the
+same directory (the gunicorn workers of a pod, or replicas mounting a shared
+volume) spends from one budget and a restart doesn't start the day over. Without
+a state directory the budget only counts the tokens of the process itself.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+
+KINDS = ("input", "output", "tool_turn")
+WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+
+# USD per million input / output tokens
+DEFAULT_PRICES = {
+    "gemini-1.5-flash-latest": (0.075, 0.30),
+    "gemini-1.5-pro-latest": (1.25, 5.00),
+}
+
+SECONDS_PER_DAY = 86400
+
+
+def parse_prices(spec: str) -> dict:
+    """Parses "model=input:output,..." (USD per million tokens) into {model: (input, output)}."""
+    prices = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, price = item.partition("=")
+        input_price, _, output_price = price.partition(":")
+        prices[model.strip()] = (float(input_price), float(output_price or input_price))
+    return prices
+
+
+class TokenUsage:
+    def __init__(self, daily_budget: int = 0, prices=None, state_dir=None):
+        self.daily_budget = daily_budget
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self.state_file = os.path.join(state_dir, "daily_tokens.json") if state_dir else None
+        self._minutes = deque()  # (minute, Counter of (variant, model, kind) -> tokens)
+        self._day = self._today()
+        self._used_today = 0
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    @staticmethod
+    def _today() -> int:
+        return int(time.time() // SECONDS_PER_DAY)
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+    def record(self, variant: str, model: str, input_tokens: int, output_tokens: int, tool_turn_tokens: int):
+        minute = int(time.time() // 60)
+        with self._lock:
+            if not self._minutes or self._minutes[-1][0] != minute:
+                self._minutes.append((minute, Counter()))
+            totals = self._minutes[-1][1]
+            totals[(variant, model, "input")] += input_tokens
+            totals[(variant, model, "output")] += output_tokens
+            totals[(variant, model, "tool_turn")] += tool_turn_tokens
+            self._expire(minute)
+
+            if self._today() != self._day:
+                self._day, self._used_today = self._today(), 0
+            self._used_today += input_tokens + output_tokens
+        if self.daily_budget and self.state_file:
+            self._shared_used_today(input_tokens + output_tokens)
+
+    def _shared_used_today(self, add: int = 0):
+        """Adds `add` to the tokens all processes sharing the state file used today and returns the total, or None."""
+        try:
+            with open(self.state_file, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX if add else fcntl.LOCK_SH)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    state = {}
+                used = (state.get("used", 0) if state.get("day") == self._today() else 0) + add
+                if add:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump({"day": self._today(), "used": used}, f)
+                return used
+        except OSError:
+            return None
+
+    def _expire(self, minute: int):
+        oldest = minute - max(WINDOWS.values()) // 60
+        while self._minutes and self._minutes[0][0] <= oldest:
+            self._minutes.popleft()
+
+    def window_totals(self) -> dict:
+        """Returns {(variant, model, kind, window): tokens} over the rolling windows."""
+        minute = int(time.time() // 60)
+        totals = Counter()
+        with self._lock:
+            self._expire(minute)
+            for bucket_minute, counts in self._minutes:
+                for window, seconds in WINDOWS.items():
+                    if bucket_minute > minute - seconds // 60:
+                        for key, tokens in counts.items():
+                            totals[key + (window,)] += tokens
+        return totals
+
+    def budget_remaining(self):
+        """Tokens left in today's budget, or None without a budget."""
+        if not self.daily_budget:
+            return None
+        used = self._shared_used_today() if self.state_file else None
+        if used is None:
+            with self._lock:
+                used = self._used_today if self._today() == self._day else 0
+        return max(self.daily_budget - used, 0)
+
+    def budget_exhausted(self) -> bool:
+        return self.budget_remaining() == 0
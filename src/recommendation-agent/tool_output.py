@@ -0,0 +1,47 @@
+"""
+Compact projection of catalog-reader responses before they are handed to the model.
+
+Everything a tool returns becomes input tokens on the next model turn, and the
+raw catalog entries carry long descriptions and picture URLs the model doesn't
+need to pick a product. project_products keeps only the configured fields,
+clips descriptions and truncates the list to the top-k matches.
+"""
+
+import json
+
+DEFAULT_FIELDS = ("id", "name", "priceUsd", "categories", "description")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (about four characters per token for English text and JSON)."""
+    return (len(text) + 3) // 4
+
+
+def format_price(money: dict) -> str:
+    units = int(money.get("units", 0))
+    cents = int(money.get("nanos", 0)) // 10_000_000
+    return f"{units}.{cents:02d} {money.get('currencyCode', 'USD')}"
+
+
+def project_product(product: dict, fields=DEFAULT_FIELDS, description_chars=None) -> dict:
+    projected = {}
+    for field in fields:
+        if field not in product:
+            continue
+        value = product[field]
+        if field == "priceUsd" and isinstance(value, dict):
+            value = format_price(value)
+        elif field == "description" and description_chars and len(value) > description_chars:
+            value = value[:description_chars].rstrip() + "..."
+        projected[field] = value
+    return projected
+
+
+def project_products(products: list, fields=DEFAULT_FIELDS, top_k=None, description_chars=None) -> list:
+    if top_k:
+        products = products[:top_k]
+    return [project_product(p, fields, description_chars) for p in products]
+
+
+def compact_json(payload) -> str:
+    return json.dumps(payload, separators=(",", ":"))
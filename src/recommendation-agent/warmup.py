@@ -0,0 +1,129 @@
+"""
+Recommendation cache warm-up from historical query logs.
+
+After a rollout the cache starts empty and the first wave of popular queries all
+go to Gemini at once. At startup the agent can instead replay the most frequent
+queries of a log through the model before it reports ready.
+
+The log is NDJSON with one /recommend request body per line, for example
+{"query": "show me mugs", "variant": "B"}; lines without a query are skipped.
+Queries are ranked by frequency per variant and the top N of each are sent to
+the model with bounded concurrency and a rate cap, so warm-up stays within quota.
+
+Run it standalone to see what would be warmed:
+
+    python warmup.py --log queries.jsonl --top 50
+"""
+
+import argparse
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from queries import is_action_intent, load_query_log
+
+
+def rank_queries(entries: list, top_n: int, key_func=lambda query: query) -> dict:
+    """
+    Ranks queries by frequency per variant and returns {variant: [(query, count), ...]}
+    with the top_n of each. Queries with the same key_func(query) are counted together
+    and represented by their most frequent spelling; action intents, which change
+    state, are left out.
+    """
+    counts = {}
+    spellings = {}
+    for query, variant in entries:
+        if is_action_intent(query):
+            continue
+        key = key_func(query)
+        counts.setdefault(variant, Counter())[key] += 1
+        spellings.setdefault((variant, key), Counter())[query] += 1
+    return {
+        variant: [(spellings[(variant, key)].most_common(1)[0][0], count)
+                  for key, count in counter.most_common(top_n)]
+        for variant, counter in counts.items()
+    }
+
+
+class RateLimiter:
+    """Spaces out acquire() calls so that at most `rate` happen per second, across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def warm_cache(fill, ranked: dict, concurrency: int, max_rps: float, timeout: float) -> dict:
+    """
+    Calls fill(query, variant) for every ranked query, at most `concurrency` at a
+    time and `max_rps` per second, giving up on whatever hasn't started by `timeout`.
+    Returns counts of warmed, failed and skipped queries, and of fills still
+    running at the deadline, which are abandoned rather than waited for.
+    """
+    limiter = RateLimiter(max_rps)
+    deadline = time.monotonic() + timeout
+    stats = Counter()
+    stats_lock = threading.Lock()
+
+    def warm(query, variant):
+        outcome = "skipped"
+        if time.monotonic() < deadline:
+            limiter.acquire()
+        # the rate limiter may have slept past the deadline
+        if time.monotonic() < deadline:
+            try:
+                fill(query, variant)
+                outcome = "warmed"
+            except Exception as e:
+                print(f"WARMUP: Failed to warm '{query}' (variant {variant}): {e}")
+                outcome = "failed"
+        with stats_lock:
+            stats[outcome] += 1
+
+    # Interleave the variants so that each gets its most popular queries in first
+    order = []
+    for rank in range(max((len(v) for v in ranked.values()), default=0)):
+        for variant, queries in sorted(ranked.items()):
+            if rank < len(queries):
+                order.append((queries[rank][0], variant))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="warmup")
+    futures = [executor.submit(warm, query, variant) for query, variant in order]
+    _, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    # Don't join fills still in flight: readiness must not wait past the deadline
+    executor.shutdown(wait=False, cancel_futures=True)
+    with stats_lock:
+        result = dict(stats)
+    # Cancelled fills never started; the rest are still running and abandoned
+    for future in not_done:
+        outcome = "skipped" if future.cancelled() else "abandoned"
+        result[outcome] = result.get(outcome, 0) + 1
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the queries a cache warm-up would replay.")
+    parser.add_argument("--log", required=True, help="NDJSON query log")
+    parser.add_argument("--top", type=int, default=50, help="Queries per variant")
+    parser.add_argument("--query-field", default="query")
+    args = parser.parse_args()
+
+    ranked = rank_queries(load_query_log(args.log, args.query_field), args.top)
+    for variant, queries in sorted(ranked.items()):
+        print(f"Variant {variant}:")
+        for query, count in queries:
+            print(f"  {count:>6}  {query}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the per-request cost of picking recommendations on large catalogs:
+the old set-difference algorithm against ProductIdStore.sample (Python path
+for small k, NumPy path for bulk k).
+
+    python benchmark_sampling.py --sizes 1000,100000,1000000
+"""
+
+import argparse
+import random
+import time
+
+from product_store import ProductIdStore
+
+
+def set_difference_sample(product_ids, excluded_ids, k):
+    # what ListRecommendations did before ProductIdStore
+    filtered_products = list(set(product_ids)-set(excluded_ids))
+    indices = random.sample(range(len(filtered_products)), min(k, len(filtered_products)))
+    return [filtered_products[i] for i in indices]
+
+
+def time_per_call(fn, min_seconds):
+    calls, start = 0, time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark exclusion sampling on large catalogs.")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="Comma-separated catalog sizes")
+    parser.add_argument("--k", default="5,1000", help="Comma-separated numbers of recommendations per request")
+    parser.add_argument("--excluded", type=int, default=10, help="Product ids in each request")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Minimum time spent per measurement")
+    args = parser.parse_args()
+
+    print("{:>9} {:>6} {:>9} {:>16} {:>16} {:>8}".format(
+        "products", "k", "excluded", "set diff (us)", "id store (us)", "speedup"))
+    for size in (int(n) for n in args.sizes.split(",")):
+        product_ids = ["P{:08d}".format(i) for i in range(size)]
+        store = ProductIdStore(product_ids)
+        for k in (int(n) for n in args.k.split(",")):
+            excluded = random.sample(product_ids, min(args.excluded, size))
+            old = time_per_call(lambda: set_difference_sample(product_ids, excluded, k), args.min_seconds)
+            new = time_per_call(lambda: store.sample(k, excluded), args.min_seconds)
+            print("{:>9} {:>6} {:>9} {:>16.1f} {:>16.1f} {:>7.0f}x".format(
+                size, k, len(excluded), old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    main()
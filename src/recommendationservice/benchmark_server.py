@@ -0,0 +1,207 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load test of recommendation_server.py in each SERVER_MODE and SERVER_WORKERS
+count: maximum throughput and tail latency of ListRecommendations at increasing
+concurrency, and the speedup over a single worker.
+
+A fake ProductCatalogService with --products synthetic products runs in this
+process. Each mode starts the real server as a subprocess against it, waits for
+its readiness check to report SERVING, and is then driven by --clients load
+processes, each running concurrency/clients asyncio callers in a closed loop.
+
+SO_REUSEPORT balances connections, not requests, so each load process opens
+--channels-per-worker channels per server worker (each its own connection) and
+spreads its callers over them. Prefork workers name themselves in the response
+trailers, and the last column shows how many requests each one served.
+
+    python benchmark_server.py --modes threads,aio --concurrency 1,16,64,256
+    python benchmark_server.py --modes threads --workers 1,2,4 --concurrency 64
+
+Run it on a machine with more cores than workers + clients, or the load
+generator competes with the server for CPU.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from concurrent import futures
+
+import grpc
+
+import demo_pb2
+import demo_pb2_grpc
+from grpc_health.v1 import health_pb2
+from grpc_health.v1 import health_pb2_grpc
+
+WORDS = ["vintage", "classic", "leather", "cotton", "steel", "kitchen", "outdoor", "summer", "travel", "home",
+         "glass", "wooden", "sport", "retro", "modern", "compact", "bag", "watch", "shirt", "lamp"]
+CATEGORIES = ["accessories", "clothing", "footwear", "hair", "beauty", "decor", "home", "kitchen"]
+
+
+class FakeProductCatalog(demo_pb2_grpc.ProductCatalogServiceServicer):
+    def __init__(self, num_products):
+        rng = random.Random(0)
+        self.products = [demo_pb2.Product(
+            id="P{:08d}".format(i),
+            name=" ".join(rng.choices(WORDS, k=3)),
+            description=" ".join(rng.choices(WORDS, k=15)),
+            categories=rng.sample(CATEGORIES, 2)) for i in range(num_products)]
+
+    def ListProducts(self, request, context):
+        return demo_pb2.ListProductsResponse(products=self.products)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, workers, port, catalog_addr):
+    env = dict(os.environ, PORT=str(port), PRODUCT_CATALOG_SERVICE_ADDR=catalog_addr,
+               SERVER_MODE=mode, SERVER_WORKERS=str(workers), DISABLE_PROFILER="1")
+    env.pop("ENABLE_TRACING", None)
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, "recommendation_server.py")],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_serving(addr, timeout):
+    deadline = time.time() + timeout
+    with grpc.insecure_channel(addr) as channel:
+        stub = health_pb2_grpc.HealthStub(channel)
+        while time.time() < deadline:
+            try:
+                response = stub.Check(health_pb2.HealthCheckRequest(service="hipstershop.RecommendationService"), timeout=1)
+                if response.status == health_pb2.HealthCheckResponse.SERVING:
+                    return
+            except grpc.RpcError:
+                pass
+            time.sleep(0.2)
+    raise Exception("server at {} not SERVING after {}s".format(addr, timeout))
+
+
+async def drive(addr, callers, num_channels, seconds, product_ids):
+    latencies, errors, served_by = [], 0, Counter()
+    deadline = time.perf_counter() + seconds
+    # A distinct channel id keeps gRPC from sharing one connection between the channels
+    channels = [grpc.aio.insecure_channel(addr, options=[("grpc.channel_id", i)]) for i in range(num_channels)]
+    stubs = [demo_pb2_grpc.RecommendationServiceStub(channel) for channel in channels]
+
+    async def caller(stub):
+        nonlocal errors
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            request = demo_pb2.ListRecommendationsRequest(user_id="bench", product_ids=rng.sample(product_ids, 2))
+            start = time.perf_counter()
+            try:
+                call = stub.ListRecommendations(request, timeout=10)
+                await call
+                latencies.append(time.perf_counter() - start)
+                trailers = await call.trailing_metadata()
+                served_by[trailers.get("x-recommendation-worker", "-")] += 1
+            except grpc.RpcError:
+                errors += 1
+
+    try:
+        await asyncio.gather(*(caller(stubs[i % num_channels]) for i in range(callers)))
+    finally:
+        for channel in channels:
+            await channel.close()
+    return latencies, errors, served_by
+
+
+def load_process(args):
+    return asyncio.run(drive(*args))
+
+
+def run_load(addr, concurrency, clients, num_channels, seconds, product_ids):
+    clients = min(clients, concurrency)
+    shares = [concurrency // clients + (i < concurrency % clients) for i in range(clients)]
+    # spawn, not fork: this process already runs a gRPC server
+    with multiprocessing.get_context("spawn").Pool(clients) as pool:
+        results = pool.map(load_process, [(addr, share, num_channels, seconds, product_ids) for share in shares])
+    latencies = sorted(l for result, _, _ in results for l in result)
+    errors = sum(e for _, e, _ in results)
+    served_by = sum((s for _, _, s in results), Counter())
+    return latencies, errors, served_by
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recommendation_server.py throughput and latency per server mode.")
+    parser.add_argument("--modes", default="threads,aio", help="Comma-separated SERVER_MODE values")
+    parser.add_argument("--concurrency", default="1,16,64,256", help="Comma-separated numbers of concurrent callers")
+    parser.add_argument("--workers", default="1", help="Comma-separated SERVER_WORKERS values")
+    parser.add_argument("--clients", type=int, default=4, help="Load generator processes")
+    parser.add_argument("--channels-per-worker", type=int, default=2,
+                        help="Channels (connections) each load process opens per server worker")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration of each measurement")
+    parser.add_argument("--products", type=int, default=1000, help="Products in the fake catalog")
+    args = parser.parse_args()
+
+    catalog = FakeProductCatalog(args.products)
+    product_ids = [p.id for p in catalog.products]
+    catalog_server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    demo_pb2_grpc.add_ProductCatalogServiceServicer_to_server(catalog, catalog_server)
+    catalog_port = catalog_server.add_insecure_port("localhost:0")
+    catalog_server.start()
+
+    print("{:>8} {:>8} {:>11} {:>10} {:>8} {:>9} {:>9} {:>9} {:>7}  {}".format(
+        "mode", "workers", "concurrency", "req/s", "speedup", "p50 (ms)", "p99 (ms)", "max (ms)", "errors",
+        "requests per worker"))
+    for mode in args.modes.split(","):
+        baseline = {}
+        for workers in (int(n) for n in args.workers.split(",")):
+            port = free_port()
+            server = start_server(mode, workers, port, "localhost:{}".format(catalog_port))
+            try:
+                addr = "localhost:{}".format(port)
+                wait_serving(addr, timeout=60)
+                for concurrency in (int(n) for n in args.concurrency.split(",")):
+                    latencies, errors, served_by = run_load(
+                        addr, concurrency, args.clients, workers * args.channels_per_worker, args.seconds, product_ids)
+                    throughput = len(latencies) / args.seconds
+                    # relative to the first --workers value at the same concurrency
+                    baseline.setdefault(concurrency, throughput)
+                    # a single server process doesn't name itself
+                    per_worker = "/".join(str(n) for _, n in served_by.most_common()) if workers > 1 else "-"
+                    print("{:>8} {:>8} {:>11} {:>10.0f} {:>7.2f}x {:>9.2f} {:>9.2f} {:>9.2f} {:>7}  {}".format(
+                        mode, workers, concurrency, throughput, throughput / (baseline[concurrency] or 1),
+                        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                        (latencies[-1] if latencies else float("nan")) * 1000, errors, per_worker), flush=True)
+            finally:
+                server.terminate()
+                server.wait()
+    catalog_server.stop(0)
+
+
+if __name__ == "__main__":
+    main()
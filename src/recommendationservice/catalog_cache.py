@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cached view of the product catalog for recommendationservice.
+
+Instead of calling ListProducts on every request, a background thread loads the
+catalog once per TTL and publishes it as an immutable CatalogSnapshot, with the
+id store and similarity index built from it. Requests
+read whatever snapshot is current without locking. If a refresh fails, the last
+good snapshot stays in place and the refresh is retried sooner.
+
+Building the similarity index takes seconds for a large catalog and holds the
+GIL, so a refresh that loads exactly the same products (same digest of their
+serialized form) reuses the previous snapshot's id store and index.
+
+Under a grpc.aio server the same cache is refreshed by a task on the event loop
+instead (start_async), with an async list_products; the snapshot is still built
+in a worker thread so it doesn't stall requests.
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+
+from product_store import ProductIdStore
+from similarity import SimilarityIndex
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-catalog')
+
+
+def catalog_version(products):
+    """Digest of the products' ids and content, to tell whether a reload changed anything."""
+    digest = hashlib.blake2b(digest_size=16)
+    for product in products:
+        data = product.SerializeToString(deterministic=True)
+        digest.update(len(data).to_bytes(4, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class CatalogSnapshot:
+    """The catalog as loaded at one point in time. Never modified after creation."""
+
+    def __init__(self, products, previous=None):
+        self.products = tuple(products)
+        self.version = catalog_version(self.products)
+        # Only a changed catalog needs a new index
+        self.unchanged = previous is not None and previous.version == self.version
+        if self.unchanged:
+            self.id_store, self.similarity = previous.id_store, previous.similarity
+        else:
+            self.id_store = ProductIdStore(p.id for p in self.products)
+            self.similarity = SimilarityIndex(self.products, self.id_store)
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.id_store)
+
+
+class CatalogCache:
+    def __init__(self, list_products, ttl_seconds, retry_seconds):
+        # list_products() returns the catalog's products, or raises if it can't
+        self.list_products = list_products
+        self.ttl_seconds = ttl_seconds
+        self.retry_seconds = min(retry_seconds, ttl_seconds)
+        self._snapshot = None
+        self._loaded = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._task = None
+
+    @property
+    def snapshot(self):
+        """The last successfully loaded snapshot, or None before the first load."""
+        return self._snapshot
+
+    @property
+    def ready(self):
+        return self._loaded.is_set()
+
+    def wait_ready(self, timeout=None):
+        return self._loaded.wait(timeout)
+
+    def refresh(self):
+        """Loads the catalog once. Returns whether it succeeded; on failure the old snapshot is kept."""
+        start = time.time()
+        try:
+            snapshot = CatalogSnapshot(self.list_products(), self._snapshot)
+        except Exception as e:
+            self._refresh_failed(start, e)
+            return False
+        self._publish(snapshot, start)
+        return True
+
+    async def refresh_async(self):
+        """refresh() for an async list_products."""
+        start = time.time()
+        try:
+            products = await self.list_products()
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, CatalogSnapshot, products, self._snapshot)
+        except Exception as e:
+            self._refresh_failed(start, e)
+            return False
+        self._publish(snapshot, start)
+        return True
+
+    def _publish(self, snapshot, start):
+        self._snapshot = snapshot
+        self._loaded.set()
+        logger.info("Catalog refreshed: {} products{} in {:.0f} ms".format(
+            len(snapshot), " (unchanged, index kept)" if snapshot.unchanged else "", (time.time() - start) * 1000))
+
+    def _refresh_failed(self, start, e):
+        age = "no snapshot yet" if self._snapshot is None else \
+            "serving snapshot from {:.0f}s ago".format(start - self._snapshot.loaded_at)
+        logger.warning("Catalog refresh failed ({}): {}".format(age, e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="catalog-refresh", daemon=True)
+        self._thread.start()
+
+    def start_async(self):
+        """Refreshes from a task on the running event loop instead of a thread."""
+        self._task = asyncio.get_running_loop().create_task(self._run_async())
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            ok = self.refresh()
+            self._stopped.wait(self.ttl_seconds if ok else self.retry_seconds)
+
+    async def _run_async(self):
+        while not self._stopped.is_set():
+            ok = await self.refresh_async()
+            await asyncio.sleep(self.ttl_seconds if ok else self.retry_seconds)
@@ -37,3 +37,11 @@ if __name__ == "__main__":
     # make call to server
     response = stub.ListRecommendations(request)
     logger.info(response)
+
+    # several contexts (e.g. the carousels of one page) in one call
+    batch_request = demo_pb2.ListRecommendationsBatchRequest(requests=[
+        demo_pb2.ListRecommendationsRequest(user_id="test", product_ids=["test"]),
+        demo_pb2.ListRecommendationsRequest(user_id="test", product_ids=[]),
+    ])
+    batch_response = stub.ListRecommendationsBatch(batch_request)
+    logger.info(batch_response)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+"Customers also bought": an item-to-item co-occurrence model fed by cart and
+order events.
+
+Events are read as NDJSON from a file that another process appends to (for
+example a log shipper writing cartservice and checkoutservice events):
+
+    {"type": "order", "user_id": "u1", "product_ids": ["OLJCESPC7Z", "66VCHSJNUP"], "timestamp": 1700000000}
+    {"type": "cart", "user_id": "u1", "product_ids": ["9SIQT8TOJO"]}
+
+Every pair of products in one order co-occurs, and so does a product added to a
+cart with the products the same user added in the last hour (with less weight).
+Pair weights decay exponentially with the event's age, so the model follows
+changing tastes. Decay is applied lazily: new weights are scaled up by
+exp(age of the model / tau) instead of scaling every old weight down, and
+everything is rebased once in a while.
+
+Memory is bounded by pruning each item's neighbours to the strongest ones and
+by evicting the least recently updated items. The top N neighbours of an item
+are recomputed whenever it changes, so a lookup is O(k).
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-cooccurrence')
+
+ORDER_WEIGHT = 1.0
+CART_WEIGHT = 0.5
+CART_SESSION_SECONDS = 3600
+CART_SESSION_ITEMS = 20
+MAX_SESSIONS = 100000
+# Rebase the lazily decayed weights before exp() gets anywhere near overflowing
+MAX_DECAY_EXPONENT = 50
+
+
+class CooccurrenceModel:
+    def __init__(self, half_life_seconds, top_n=20, max_neighbors=100, max_items=100000):
+        self.tau = half_life_seconds / math.log(2)
+        self.top_n = top_n
+        self.max_neighbors = max_neighbors
+        self.max_items = max_items
+        self._reference_time = time.time()
+        self._neighbors = OrderedDict()  # item -> {neighbor: scaled weight}
+        self._top = {}  # item -> tuple of its top_n neighbors, best first
+        self._sessions = OrderedDict()  # user -> deque of (product id, time) added to the cart
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._neighbors)
+
+    def add_event(self, event_type, user_id, product_ids, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        product_ids = list(dict.fromkeys(p for p in product_ids if p))
+        with self._lock:
+            if event_type == "order":
+                pairs = [(a, b, ORDER_WEIGHT) for i, a in enumerate(product_ids) for b in product_ids[i + 1:]]
+            elif event_type == "cart":
+                pairs = self._cart_pairs(user_id, product_ids, timestamp)
+            else:
+                return
+            scale = self._scale(timestamp)
+            touched = set()
+            for a, b, weight in pairs:
+                self._add(a, b, weight * scale)
+                self._add(b, a, weight * scale)
+                touched.update((a, b))
+            for item in touched:
+                self._prune(item)
+                self._top[item] = self._top_neighbors(item)
+            self._evict()
+
+    def _cart_pairs(self, user_id, product_ids, timestamp):
+        session = self._sessions.pop(user_id, None) or deque(maxlen=CART_SESSION_ITEMS)
+        while session and session[0][1] < timestamp - CART_SESSION_SECONDS:
+            session.popleft()
+        pairs = [(earlier, p, CART_WEIGHT) for earlier, _ in session for p in product_ids if earlier != p]
+        session.extend((p, timestamp) for p in product_ids)
+        self._sessions[user_id] = session
+        while len(self._sessions) > MAX_SESSIONS:
+            self._sessions.popitem(last=False)
+        return pairs
+
+    def _scale(self, timestamp):
+        exponent = (timestamp - self._reference_time) / self.tau
+        if exponent > MAX_DECAY_EXPONENT:
+            self._rebase(timestamp)
+            exponent = 0
+        return math.exp(exponent)
+
+    def _rebase(self, timestamp):
+        factor = math.exp(-(timestamp - self._reference_time) / self.tau)
+        for neighbors in self._neighbors.values():
+            for neighbor in neighbors:
+                neighbors[neighbor] *= factor
+        self._reference_time = timestamp
+
+    def _add(self, item, neighbor, weight):
+        neighbors = self._neighbors.pop(item, None) or {}
+        neighbors[neighbor] = neighbors.get(neighbor, 0.0) + weight
+        self._neighbors[item] = neighbors
+
+    def _prune(self, item):
+        # Let the dict grow to twice the limit so pruning is amortized
+        neighbors = self._neighbors[item]
+        if len(neighbors) > 2 * self.max_neighbors:
+            strongest = sorted(neighbors.items(), key=lambda kv: kv[1], reverse=True)[:self.max_neighbors]
+            self._neighbors[item] = dict(strongest)
+
+    def _top_neighbors(self, item):
+        neighbors = self._neighbors[item]
+        return tuple(sorted(neighbors, key=neighbors.get, reverse=True)[:self.top_n])
+
+    def _evict(self):
+        while len(self._neighbors) > self.max_items:
+            item, _ = self._neighbors.popitem(last=False)
+            self._top.pop(item, None)
+
+    def recommend(self, product_ids, k):
+        """Up to k ids bought together with the given products, taking turns between them."""
+        tops = [self._top.get(p, ()) for p in product_ids]
+        exclude = set(product_ids)
+        result = []
+        for rank in range(self.top_n):
+            for top in tops:
+                if rank < len(top) and top[rank] not in exclude:
+                    exclude.add(top[rank])
+                    result.append(top[rank])
+                    if len(result) == k:
+                        return result
+        return result
+
+
+class EventTailer:
+    """Follows an NDJSON event file, like tail -F, and feeds the events to a model."""
+
+    def __init__(self, path, model, poll_seconds=1.0):
+        self.path = path
+        self.model = model
+        self.poll_seconds = poll_seconds
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="event-tailer", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        f, inode = None, None
+        while not self._stopped.is_set():
+            try:
+                if f is None:
+                    f = open(self.path, "rb")
+                    inode = os.fstat(f.fileno()).st_ino
+                    logger.info("Reading cart and order events from {}".format(self.path))
+                line = f.readline()
+                if line.endswith(b"\n"):
+                    self._handle(line)
+                    continue
+                # At the end of the file: put back a partly written line and wait
+                f.seek(-len(line), os.SEEK_CUR)
+                if self._replaced(inode, f.tell()):
+                    f.close()
+                    f = None
+                    continue
+            except OSError as e:
+                logger.warning("Cannot read events from {}: {}".format(self.path, e))
+                if f is not None:
+                    f.close()
+                f = None
+            self._stopped.wait(self.poll_seconds)
+
+    def _replaced(self, inode, position):
+        # The file was rotated (new inode) or truncated
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_ino != inode or stat.st_size < position
+
+    def _handle(self, line):
+        try:
+            event = json.loads(line)
+            self.model.add_event(event["type"], event.get("user_id", ""), event["product_ids"], event.get("timestamp"))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Skipping malformed event: {}".format(e))
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prefork supervisor: runs N copies of the server in forked processes, so a
+CPU-bound Python server can use every core despite the GIL.
+
+Each worker binds the same port with SO_REUSEPORT and the kernel spreads
+incoming connections between them. Workers share nothing: each loads its own
+catalog cache. The supervisor only watches them, restarts any that exit (backing
+off if one keeps crashing right after start), and stops them all on SIGTERM.
+
+gRPC must not have created any channel or server in the supervisor before the
+workers are forked.
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+
+from logger import getJSONLogger
+logger = getJSONLogger('recommendationservice-prefork')
+
+# A worker that exits sooner than this after starting is crash-looping
+MIN_UPTIME_SECONDS = 10
+MAX_RESTART_DELAY_SECONDS = 30
+STOP_TIMEOUT_SECONDS = 10
+
+
+CGROUP_V2_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+CGROUP_V1_CPU_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+CGROUP_V1_CPU_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_quota():
+    """The container's CPU limit in cores from its cgroup (v2 or v1), or None if it has none."""
+    cpu_max = _read(CGROUP_V2_CPU_MAX)
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota, period = _read(CGROUP_V1_CPU_QUOTA), _read(CGROUP_V1_CPU_PERIOD)
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        # "max" (v2) or missing files: no limit
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def worker_count(value):
+    """
+    SERVER_WORKERS: a number of processes, or "auto" for one per usable core. A
+    core counts only if the container's CPU quota covers it entirely: a pod
+    limited to 200m gets one worker, however many cores the node has.
+    """
+    if value == "auto":
+        cores = len(os.sched_getaffinity(0))
+        quota = cpu_quota()
+        if quota is not None:
+            cores = min(cores, int(quota))
+        return max(1, cores)
+    return max(1, int(value))
+
+
+def _worker_main(target, args):
+    # the supervisor's signal handlers are inherited across fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    target(*args)
+
+
+class Supervisor:
+    def __init__(self, num_workers, target, args=(), restart_delay_seconds=1.0):
+        self.num_workers = num_workers
+        self.target = target
+        self.args = args
+        self.restart_delay_seconds = restart_delay_seconds
+        self._context = multiprocessing.get_context("fork")
+        self._workers = [None] * num_workers
+        self._started_at = [0.0] * num_workers
+        self._next_start = [0.0] * num_workers
+        self._delay = [restart_delay_seconds] * num_workers
+        self._stopping = False
+
+    def _spawn(self, slot):
+        process = self._context.Process(target=_worker_main, args=(self.target, self.args),
+                                        name="worker-{}".format(slot))
+        process.start()
+        self._workers[slot] = process
+        self._started_at[slot] = time.time()
+        logger.info("Started worker {} (pid {})".format(slot, process.pid))
+
+    def _reap(self, slot):
+        process = self._workers[slot]
+        process.join()
+        uptime = time.time() - self._started_at[slot]
+        if uptime < MIN_UPTIME_SECONDS:
+            self._delay[slot] = min(self._delay[slot] * 2, MAX_RESTART_DELAY_SECONDS)
+        else:
+            self._delay[slot] = self.restart_delay_seconds
+        self._next_start[slot] = time.time() + self._delay[slot]
+        self._workers[slot] = None
+        logger.warning("Worker {} (pid {}) exited with code {} after {:.0f}s, restarting in {:.0f}s".format(
+            slot, process.pid, process.exitcode, uptime, self._delay[slot]))
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        """Starts the workers and keeps them running until SIGTERM or SIGINT."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info("Starting {} workers".format(self.num_workers))
+        while not self._stopping:
+            now = time.time()
+            for slot, process in enumerate(self._workers):
+                if process is None and now >= self._next_start[slot]:
+                    self._spawn(slot)
+                elif process is not None and not process.is_alive():
+                    self._reap(slot)
+            sentinels = [p.sentinel for p in self._workers if p is not None]
+            multiprocessing.connection.wait(sentinels, timeout=1.0)
+        self.shutdown()
+
+    def shutdown(self):
+        workers = [p for p in self._workers if p is not None]
+        for process in workers:
+            process.terminate()
+        deadline = time.time() + STOP_TIMEOUT_SECONDS
+        for process in workers:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        logger.info("Stopped {} workers".format(len(workers)))
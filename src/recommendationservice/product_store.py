@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Array-backed product id store with sampling that excludes a few ids.
+
+The ids live in one array, with a dict from id to position. Picking k random
+products other than the ones in the request no longer touches the whole catalog:
+the excluded ids are mapped to positions, k + |excluded| distinct positions are
+drawn, the excluded ones are rejected and the first k that remain are returned.
+That costs O(k + |excluded|) time and memory however large the catalog is, and
+the result is still a uniformly random k-subset of the allowed products.
+
+Large requests (k >= BULK_THRESHOLD) do the same with NumPy.
+"""
+
+import random
+
+import numpy as np
+
+BULK_THRESHOLD = 64
+
+
+class ProductIdStore:
+    def __init__(self, product_ids):
+        # dict.fromkeys drops duplicates and keeps the catalog order
+        self.ids = np.array(list(dict.fromkeys(product_ids)), dtype=object)
+        self.position = {product_id: i for i, product_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def excluded_positions(self, excluded_ids):
+        return {self.position[p] for p in excluded_ids if p in self.position}
+
+    def sample(self, k, excluded_ids=(), rng=random):
+        """Returns up to k distinct random ids that are not in excluded_ids."""
+        excluded = self.excluded_positions(excluded_ids)
+        k = min(k, len(self.ids) - len(excluded))
+        if k <= 0:
+            return []
+        if k >= BULK_THRESHOLD:
+            return self.sample_bulk(k, excluded)
+        # random.sample picks from a range in O(draws) without building it
+        candidates = rng.sample(range(len(self.ids)), k + len(excluded))
+        return [self.ids[i] for i in candidates if i not in excluded][:k]
+
+    def sample_bulk(self, k, excluded, rng=None):
+        """NumPy version of sample() for large k; `excluded` is a set of positions."""
+        rng = rng or np.random.default_rng()
+        candidates = rng.choice(len(self.ids), size=k + len(excluded), replace=False)
+        if excluded:
+            candidates = candidates[~np.isin(candidates, np.fromiter(excluded, dtype=np.int64))]
+        return self.ids[candidates[:k]].tolist()
@@ -14,8 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import os
-import random
 import time
 import traceback
 from concurrent import futures
@@ -26,11 +26,15 @@ import grpc
 
 import demo_pb2
 import demo_pb2_grpc
+from catalog_cache import CatalogCache
+from cooccurrence import CooccurrenceModel, EventTailer
+from prefork import Supervisor, worker_count
 from grpc_health.v1 import health_pb2
 from grpc_health.v1 import health_pb2_grpc
 
 from opentelemetry import trace
 from opentelemetry.instrumentation.grpc import GrpcInstrumentorClient, GrpcInstrumentorServer
+from opentelemetry.instrumentation.grpc import GrpcAioInstrumentorClient, GrpcAioInstrumentorServer
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
@@ -38,6 +42,14 @@ from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExport
 from logger import getJSONLogger
 logger = getJSONLogger('recommendationservice-server')
 
+CATALOG_RPC_TIMEOUT = float(os.environ.get('CATALOG_RPC_TIMEOUT_SECONDS', "5"))
+# health check service name that reports readiness (the empty name reports liveness)
+SERVICE_NAME = "hipstershop.RecommendationService"
+# trailing metadata naming the prefork worker (its pid) that served a request
+WORKER_METADATA_KEY = "x-recommendation-worker"
+# most contexts a single ListRecommendationsBatch call may ask for
+MAX_BATCH_SIZE = int(os.environ.get('RECOMMENDATION_MAX_BATCH_SIZE', "100"))
+
 def initStackdriverProfiling():
   project_id = None
   try:
@@ -64,36 +76,197 @@ def initStackdriverProfiling():
   return
 
 class RecommendationService(demo_pb2_grpc.RecommendationServiceServicer):
-    def ListRecommendations(self, request, context):
-        max_responses = 5
-        # fetch list of products from product catalog stub
-        cat_response = product_catalog_stub.ListProducts(demo_pb2.Empty())
-        product_ids = [x.id for x in cat_response.products]
-        filtered_products = list(set(product_ids)-set(request.product_ids))
-        num_products = len(filtered_products)
-        num_return = min(max_responses, num_products)
-        # sample list of indicies to return
-        indices = random.sample(range(num_products), num_return)
-        # fetch product ids from indices
-        prod_list = [filtered_products[i] for i in indices]
+    def __init__(self, catalog, cooccurrence=None, worker=None):
+        self.catalog = catalog
+        # optional "customers also bought" model; None when no event stream is configured
+        self.cooccurrence = cooccurrence
+        # with SERVER_WORKERS > 1, responses say which worker served them (see benchmark_server.py)
+        self.worker_metadata = ((WORKER_METADATA_KEY, str(worker)),) if worker is not None else None
+
+    def recommend(self, snapshot, product_ids, max_responses=5):
+        # products bought together with the ones in the request, then the most
+        # similar ones, topped up with random ones
+        prod_list = []
+        if self.cooccurrence is not None:
+            prod_list = [p for p in self.cooccurrence.recommend(product_ids, max_responses)
+                         if p in snapshot.id_store.position]
+        if len(prod_list) < max_responses:
+            similar = snapshot.similarity.similar(product_ids, max_responses)
+            prod_list += [p for p in similar if p not in prod_list][:max_responses - len(prod_list)]
+        if len(prod_list) < max_responses:
+            prod_list += snapshot.id_store.sample(
+                max_responses - len(prod_list), list(product_ids) + prod_list)
         logger.info("[Recv ListRecommendations] product_ids={}".format(prod_list))
         # build and return response
         response = demo_pb2.ListRecommendationsResponse()
         response.product_ids.extend(prod_list)
         return response
 
+    def recommend_batch(self, snapshot, requests):
+        # every context is answered from the same catalog snapshot
+        response = demo_pb2.ListRecommendationsBatchResponse()
+        response.responses.extend(self.recommend(snapshot, r.product_ids) for r in requests)
+        return response
+
+    def ListRecommendations(self, request, context):
+        # read product ids from the cached catalog snapshot
+        snapshot = self.catalog.snapshot
+        if snapshot is None:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "product catalog not loaded yet")
+        if self.worker_metadata:
+            context.set_trailing_metadata(self.worker_metadata)
+        return self.recommend(snapshot, request.product_ids)
+
+    def ListRecommendationsBatch(self, request, context):
+        snapshot = self.catalog.snapshot
+        if snapshot is None:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "product catalog not loaded yet")
+        if len(request.requests) > MAX_BATCH_SIZE:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "at most {} requests per batch".format(MAX_BATCH_SIZE))
+        if self.worker_metadata:
+            context.set_trailing_metadata(self.worker_metadata)
+        return self.recommend_batch(snapshot, request.requests)
+
+    def health(self, service):
+        """
+        The empty service name is the liveness check and is always SERVING. The
+        service's own name is the readiness check, which stays NOT_SERVING until
+        the catalog has been loaded once. Returns None for any other name.
+        """
+        if service == "":
+            status = health_pb2.HealthCheckResponse.SERVING
+        elif service == SERVICE_NAME:
+            status = health_pb2.HealthCheckResponse.SERVING if self.catalog.ready \
+                else health_pb2.HealthCheckResponse.NOT_SERVING
+        else:
+            return None
+        return health_pb2.HealthCheckResponse(status=status)
+
     def Check(self, request, context):
-        return health_pb2.HealthCheckResponse(
-            status=health_pb2.HealthCheckResponse.SERVING)
+        response = self.health(request.service)
+        if response is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "unknown service " + request.service)
+        return response
 
     def Watch(self, request, context):
         return health_pb2.HealthCheckResponse(
             status=health_pb2.HealthCheckResponse.UNIMPLEMENTED)
 
 
-if __name__ == "__main__":
-    logger.info("initializing recommendationservice")
+class AsyncRecommendationService(RecommendationService):
+    """The same service for a grpc.aio server, with coroutine handlers."""
+
+    async def ListRecommendations(self, request, context):
+        snapshot = self.catalog.snapshot
+        if snapshot is None:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "product catalog not loaded yet")
+        if self.worker_metadata:
+            context.set_trailing_metadata(self.worker_metadata)
+        return self.recommend(snapshot, request.product_ids)
+
+    async def ListRecommendationsBatch(self, request, context):
+        snapshot = self.catalog.snapshot
+        if snapshot is None:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, "product catalog not loaded yet")
+        if len(request.requests) > MAX_BATCH_SIZE:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "at most {} requests per batch".format(MAX_BATCH_SIZE))
+        if self.worker_metadata:
+            context.set_trailing_metadata(self.worker_metadata)
+        return self.recommend_batch(snapshot, request.requests)
+
+    async def Check(self, request, context):
+        response = self.health(request.service)
+        if response is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "unknown service " + request.service)
+        return response
+
+    async def Watch(self, request, context):
+        await context.abort(grpc.StatusCode.UNIMPLEMENTED, "health watch is not implemented")
+
+
+def new_catalog_cache(list_products):
+    # cache the catalog, refreshed in the background every CATALOG_REFRESH_SECONDS
+    return CatalogCache(
+        list_products,
+        ttl_seconds=float(os.environ.get('CATALOG_REFRESH_SECONDS', "60")),
+        retry_seconds=float(os.environ.get('CATALOG_RETRY_SECONDS', "5")))
+
 
+def serve(port, catalog_addr, cooccurrence, options=(), worker=None):
+    """Thread-pool server with a blocking ProductCatalog client."""
+    channel = grpc.insecure_channel(catalog_addr)
+    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
+    catalog = new_catalog_cache(
+        lambda: product_catalog_stub.ListProducts(demo_pb2.Empty(), timeout=CATALOG_RPC_TIMEOUT).products)
+    catalog.start()
+
+    # create gRPC server
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=options)
+
+    # add class to gRPC server
+    service = RecommendationService(catalog, cooccurrence, worker)
+    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
+    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+    # start server
+    logger.info("listening on port: " + port)
+    server.add_insecure_port('[::]:'+port)
+    server.start()
+
+    # keep alive
+    try:
+         while True:
+            time.sleep(10000)
+    except KeyboardInterrupt:
+            server.stop(0)
+
+
+async def serve_aio(port, catalog_addr, cooccurrence, options=(), worker=None):
+    """grpc.aio server and ProductCatalog client sharing one event loop."""
+    channel = grpc.aio.insecure_channel(catalog_addr)
+    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
+
+    async def list_products():
+        response = await product_catalog_stub.ListProducts(demo_pb2.Empty(), timeout=CATALOG_RPC_TIMEOUT)
+        return response.products
+
+    catalog = new_catalog_cache(list_products)
+    catalog.start_async()
+
+    server = grpc.aio.server(options=options)
+    service = AsyncRecommendationService(catalog, cooccurrence, worker)
+    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
+    health_pb2_grpc.add_HealthServicer_to_server(service, server)
+
+    logger.info("listening on port: " + port + " (asyncio)")
+    server.add_insecure_port('[::]:'+port)
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        catalog.stop()
+        await channel.close()
+
+
+def new_cooccurrence_model():
+    # learn "customers also bought" from cart and order events appended to COOCCURRENCE_EVENTS_PATH
+    events_path = os.environ.get('COOCCURRENCE_EVENTS_PATH', '')
+    if not events_path:
+        return None
+    cooccurrence = CooccurrenceModel(
+        half_life_seconds=float(os.environ.get('COOCCURRENCE_HALF_LIFE_HOURS', "168")) * 3600,
+        top_n=int(os.environ.get('COOCCURRENCE_TOP_N', "20")),
+        max_neighbors=int(os.environ.get('COOCCURRENCE_MAX_NEIGHBORS', "100")),
+        max_items=int(os.environ.get('COOCCURRENCE_MAX_ITEMS', "100000")))
+    EventTailer(events_path, cooccurrence).start()
+    return cooccurrence
+
+
+def initTelemetry(server_mode):
+    # Starts profiler threads and may open the trace exporter's gRPC channel, so
+    # with SERVER_WORKERS > 1 it must run in each worker, after the fork
     try:
       if "DISABLE_PROFILER" in os.environ:
         raise KeyError()
@@ -104,9 +277,13 @@ if __name__ == "__main__":
         logger.info("Profiler disabled.")
 
     try:
-      grpc_client_instrumentor = GrpcInstrumentorClient()
+      if server_mode == "aio":
+        grpc_client_instrumentor = GrpcAioInstrumentorClient()
+        grpc_server_instrumentor = GrpcAioInstrumentorServer()
+      else:
+        grpc_client_instrumentor = GrpcInstrumentorClient()
+        grpc_server_instrumentor = GrpcInstrumentorServer()
       grpc_client_instrumentor.instrument()
-      grpc_server_instrumentor = GrpcInstrumentorServer()
       grpc_server_instrumentor.instrument()
       if os.environ["ENABLE_TRACING"] == "1":
         trace.set_tracer_provider(TracerProvider())
@@ -124,30 +301,38 @@ if __name__ == "__main__":
     except Exception as e:
         logger.warn(f"Exception on Cloud Trace setup: {traceback.format_exc()}, tracing disabled.") 
 
+
+def run_server(server_mode, port, catalog_addr, prefork=False):
+    """Runs one server process; with SERVER_WORKERS > 1, each worker runs this after the fork."""
+    initTelemetry(server_mode)
+    cooccurrence = new_cooccurrence_model()
+    # prefork workers share the port and tag their responses with their pid
+    options = [("grpc.so_reuseport", 1)] if prefork else ()
+    worker = os.getpid() if prefork else None
+    if server_mode == "aio":
+        asyncio.run(serve_aio(port, catalog_addr, cooccurrence, options, worker))
+    else:
+        serve(port, catalog_addr, cooccurrence, options, worker)
+
+
+if __name__ == "__main__":
+    logger.info("initializing recommendationservice")
+
+    # SERVER_MODE=aio serves with grpc.aio instead of a thread pool
+    server_mode = os.environ.get('SERVER_MODE', "threads")
+    if server_mode not in ("threads", "aio"):
+        raise Exception('SERVER_MODE must be "threads" or "aio", not ' + server_mode)
+
     port = os.environ.get('PORT', "8080")
     catalog_addr = os.environ.get('PRODUCT_CATALOG_SERVICE_ADDR', '')
     if catalog_addr == "":
         raise Exception('PRODUCT_CATALOG_SERVICE_ADDR environment variable not set')
     logger.info("product catalog address: " + catalog_addr)
-    channel = grpc.insecure_channel(catalog_addr)
-    product_catalog_stub = demo_pb2_grpc.ProductCatalogServiceStub(channel)
-
-    # create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-
-    # add class to gRPC server
-    service = RecommendationService()
-    demo_pb2_grpc.add_RecommendationServiceServicer_to_server(service, server)
-    health_pb2_grpc.add_HealthServicer_to_server(service, server)
-
-    # start server
-    logger.info("listening on port: " + port)
-    server.add_insecure_port('[::]:'+port)
-    server.start()
 
-    # keep alive
-    try:
-         while True:
-            time.sleep(10000)
-    except KeyboardInterrupt:
-            server.stop(0)
+    # SERVER_WORKERS > 1 (or "auto") preforks that many servers sharing the port;
+    # nothing above may start a thread or open a gRPC channel
+    num_workers = worker_count(os.environ.get('SERVER_WORKERS', "1"))
+    if num_workers > 1:
+        Supervisor(num_workers, run_server, (server_mode, port, catalog_addr, True)).run()
+    else:
+        run_server(server_mode, port, catalog_addr)
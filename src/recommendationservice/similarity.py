@@ -0,0 +1,112 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-based "similar items" from TF-IDF vectors of the catalog.
+
+When a catalog snapshot is loaded, every product gets a TF-IDF vector over the
+words of its name and description and over its categories (as separate terms,
+weighted higher, since sharing a category says more than sharing a word). The
+rows are L2-normalized and stored as a sparse matrix in coordinate form: three
+NumPy arrays of row, column and value.
+
+For a request, the rows of its products are summed into one query vector; a
+single sparse matrix-vector product gives the cosine similarity of every product
+to it, and argpartition picks the top k without sorting the whole catalog.
+"""
+
+import math
+import re
+from collections import Counter
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+CATEGORY_WEIGHT = 2.0
+# Words too common in product text to say anything about similarity
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "its", "of", "on",
+    "or", "that", "the", "this", "to", "with", "your", "you",
+}
+
+
+def product_terms(product):
+    """Term -> weight for one product."""
+    terms = Counter()
+    for token in TOKEN_PATTERN.findall("{} {}".format(product.name, product.description).lower()):
+        if token not in STOP_WORDS:
+            terms[token] += 1
+    for category in product.categories:
+        terms["category:" + category.lower()] += CATEGORY_WEIGHT
+    return terms
+
+
+class SimilarityIndex:
+    def __init__(self, products, id_store):
+        # Rows follow the id store's positions; a duplicated id keeps its first product
+        by_id = {}
+        for product in products:
+            by_id.setdefault(product.id, product)
+        term_rows = [product_terms(by_id[product_id]) for product_id in id_store.ids]
+
+        vocabulary = {}
+        document_frequency = Counter()
+        for terms in term_rows:
+            document_frequency.update(terms.keys())
+        for term in document_frequency:
+            vocabulary[term] = len(vocabulary)
+        num_rows = len(term_rows)
+        idf = {term: math.log((1 + num_rows) / (1 + df)) + 1 for term, df in document_frequency.items()}
+
+        rows, columns, values = [], [], []
+        for row, terms in enumerate(term_rows):
+            weights = {term: (1 + math.log(count)) * idf[term] for term, count in terms.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for term, weight in weights.items():
+                rows.append(row)
+                columns.append(vocabulary[term])
+                values.append(weight / norm)
+
+        self.id_store = id_store
+        self.num_terms = len(vocabulary)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.columns = np.array(columns, dtype=np.int64)
+        self.values = np.array(values, dtype=np.float32)
+        # Where each row's entries start, to pull out single rows for query vectors
+        self.row_starts = np.searchsorted(self.rows, np.arange(num_rows + 1))
+
+    def query_vector(self, positions):
+        vector = np.zeros(self.num_terms, dtype=np.float32)
+        for position in positions:
+            start, end = self.row_starts[position], self.row_starts[position + 1]
+            vector[self.columns[start:end]] += self.values[start:end]
+        return vector
+
+    def scores(self, vector):
+        """Cosine similarity of every product to a query vector (one sparse matrix-vector product)."""
+        return np.bincount(self.rows, weights=self.values * vector[self.columns], minlength=len(self.id_store))
+
+    def similar(self, product_ids, k):
+        """Up to k ids most similar to the given products, best first, excluding them and unrelated items."""
+        positions = self.id_store.excluded_positions(product_ids)
+        if not positions or k <= 0:
+            return []
+        scores = self.scores(self.query_vector(positions))
+        scores[list(positions)] = 0
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.id_store.ids[i] for i in top if scores[i] > 0]